@@ -0,0 +1,35 @@
+from __future__ import print_function
+from __future__ import division
+import sys, re, time
+import numpy as np
+
+sys.path.append('../../src')
+import lib_utils as utils
+
+#Throughput of the decoding of QE numeric text blocks:
+#re.split + float() list comprehension vs. utils.xml_text2array
+
+nvalues = 10**6   #number of complex values in the block
+nrepeat = 3
+
+aux  = np.random.rand(nvalues,2)
+text = '\n'.join([' {0:.15E},{1:.15E}'.format(x,y) for x,y in aux])
+mb   = len(text)/1024**2
+
+def decode_split(text):
+    aux = np.array([float(i) for i in re.split(',|\n',text.strip())])
+    aux = aux.reshape((len(aux)//2,2))
+    return aux[:,0]+1j*aux[:,1]
+
+def decode_fast(text):
+    return utils.xml_text2array(text,'complex')
+
+if not np.array_equal(decode_split(text),decode_fast(text)):
+    sys.exit('The two decoders do not agree')
+
+for label,decode in [('re.split + float()',decode_split),('xml_text2array',decode_fast)]:
+    tic = time.time()
+    for i in range(nrepeat):
+        decode(text)
+    toc = (time.time()-tic)/nrepeat
+    print('{0:20s}: {1:8.3f} s  {2:8.1f} MB/s'.format(label,toc,mb/toc))
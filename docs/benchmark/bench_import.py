@@ -0,0 +1,46 @@
+from __future__ import print_function
+from __future__ import division
+import os, sys, subprocess, json
+
+#Start-up cost of the compute modules: wall time, peak RSS and the heavy
+#modules loaded by a fresh interpreter that only imports them.
+#lib_plot is the reference for the cost of matplotlib. The script exits
+#with an error if a compute module pulls in matplotlib.
+
+modules  = ['lib_utils','lib_pytb','lib_dos','lib_server','lib_plot']
+heavy    = ['numpy','scipy','matplotlib','mpi4py']
+headless = ['lib_utils','lib_pytb','lib_dos','lib_server']
+nrepeat  = 5
+
+src   = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+probe = '''
+import sys, time, json, resource
+sys.path.insert(0,{0!r})
+tic = time.time()
+import {1:s}
+toc = time.time()-tic
+print(json.dumps({{'time':toc,'rss':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+                  'loaded':[aux for aux in {2!r} if aux in sys.modules]}}))
+'''
+
+def time_import(module):
+    env = dict(os.environ)
+    env.pop('MPLBACKEND',None)
+    runs = []
+    for i in range(nrepeat):
+        out = subprocess.check_output([sys.executable,'-c',probe.format(src,module,heavy)],env=env)
+        runs.append(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+    return runs
+
+print('{0:12s} {1:>10s} {2:>10s}  {3:s}'.format('module','time (ms)','RSS (MB)','heavy modules loaded'))
+failed = []
+for module in modules:
+    runs = time_import(module)
+    toc  = min([aux['time'] for aux in runs])*1000
+    rss  = min([aux['rss'] for aux in runs])
+    print('{0:12s} {1:10.1f} {2:10.1f}  {3:s}'.format(module,toc,rss,' '.join(runs[0]['loaded'])))
+    if module in headless and 'matplotlib' in runs[0]['loaded']:
+        failed.append(module)
+
+if failed:
+    sys.exit('matplotlib is imported by {0:s}'.format(' '.join(failed)))
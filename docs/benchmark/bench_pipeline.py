@@ -0,0 +1,273 @@
+from __future__ import print_function
+from __future__ import division
+import sys, os, time, json, shutil, argparse, platform, subprocess, resource
+import multiprocessing
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+os.environ.setdefault('MPLBACKEND','Agg')
+import lib_pytb as lib
+
+#Synthetic benchmark of the pipeline stages:
+#  read_QE_output_xml_v4 -> build_Hk_5 -> get_WS_supercell -> build_HR_par_6 -> get_interpolated_bands_3
+#A random short-range H(R),S(R) model is diagonalized on the full nx x ny x nz grid and written as
+#QE-style data-file.xml and atomic_proj.xml (projections U = S^1/2 c, so build_Hk_5 gives back H(k)).
+#Every stage runs in its own process; its time and peak resident memory go to a JSON file.
+#
+#example: python bench_pipeline.py --nawf 8 16 --grid 4x4x4 8x8x8 --json bench.json
+
+alat      = 10.26   #Bohrs, fcc
+a_vectors = alat/2*np.array([[-1.0,0.0,1.0],[0.0,1.0,1.0],[-1.0,1.0,0.0]])
+Kfrac     = [[0.0,0.0,0.0],[0.5,0.0,0.5],[0.5,0.25,0.75],[0.5,0.5,0.5],[0.0,0.0,0.0]]
+
+def make_model(nawf,nspin,grid,seed=0):
+    """
+    Random Hermitian model with H(R),S(R) on the nearest-neighbour shell:
+    returns kpnts[nk,3] (2pi/alat), Hk[nk,nspin,nawf,nawf], Sk[nk,nawf,nawf]
+    """
+    rng   = np.random.RandomState(seed)
+    nx,ny,nz = grid
+    Rlist = [(0,0,0),(1,0,0),(0,1,0),(0,0,1),(1,-1,0),(0,1,-1),(1,0,-1)]
+    HR    = rng.randn(len(Rlist),nspin,nawf,nawf)+1j*rng.randn(len(Rlist),nspin,nawf,nawf)
+    SR    = 0.02*(rng.randn(len(Rlist),nawf,nawf)+1j*rng.randn(len(Rlist),nawf,nawf))
+    SR[0] = np.eye(nawf)
+
+    i1,i2,i3 = np.meshgrid(np.arange(nx)/nx,np.arange(ny)/ny,np.arange(nz)/nz,indexing='ij')
+    kfrac = np.column_stack((i1.ravel(),i2.ravel(),i3.ravel()))
+    phase = np.exp(2j*np.pi*np.dot(kfrac,np.array(Rlist).T))        #[nk,nR]
+    Hk    = np.einsum('kr,rsij->ksij',phase,HR)
+    Sk    = np.einsum('kr,rij->kij',phase,SR)
+    Hk    = Hk + np.conj(np.swapaxes(Hk,2,3))
+    Sk    = 0.5*(Sk + np.conj(np.swapaxes(Sk,1,2)))
+    kpnts = np.dot(kfrac,np.linalg.inv(a_vectors/alat).T)            #2pi/alat
+    return kpnts,Hk,Sk
+def format_block(values,dtype='real'):
+    if dtype == 'complex':
+        aux = np.column_stack((np.real(values),np.imag(values))).ravel()
+        return (' %.15E,%.15E\n'*len(values)) % tuple(aux)
+    return (' %.15E\n'*len(values)) % tuple(values)
+def write_data_file_xml(fname,nkpnts,nspin,nbnds,natoms,kpnts,seed=0):
+    """
+    Minimal data-file.xml (QE 5 format) with the tags read by read_QE_data_file_xml_v2
+    """
+    rng = np.random.RandomState(seed)
+    b_vectors = np.linalg.inv(a_vectors/alat).T
+    with open(fname,'w') as f:
+        f.write('<?xml version="1.0"?>\n<Root>\n  <CELL>\n')
+        f.write('    <LATTICE_PARAMETER type="real" size="1" UNITS="Bohr">\n {0:.15E}\n'
+                '    </LATTICE_PARAMETER>\n'.format(alat))
+        f.write('    <DIRECT_LATTICE_VECTORS>\n      <UNITS_FOR_DIRECT_LATTICE_VECTORS UNITS="Bohr"/>\n')
+        for i in range(3):
+            f.write('      <a{0:d} type="real" size="3" columns="3">\n {1:s}\n      </a{0:d}>\n'.format(
+                    i+1,' '.join(['{0:.15E}'.format(x) for x in a_vectors[i]])))
+        f.write('    </DIRECT_LATTICE_VECTORS>\n    <RECIPROCAL_LATTICE_VECTORS>\n'
+                '      <UNITS_FOR_RECIPROCAL_LATTICE_VECTORS UNITS="2 pi / a"/>\n')
+        for i in range(3):
+            f.write('      <b{0:d} type="real" size="3" columns="3">\n {1:s}\n      </b{0:d}>\n'.format(
+                    i+1,' '.join(['{0:.15E}'.format(x) for x in b_vectors[i]])))
+        f.write('    </RECIPROCAL_LATTICE_VECTORS>\n  </CELL>\n  <IONS>\n')
+        f.write('    <NUMBER_OF_ATOMS type="integer" size="1">\n {0:d}\n    </NUMBER_OF_ATOMS>\n'.format(natoms))
+        f.write('    <NUMBER_OF_SPECIES type="integer" size="1">\n 1\n    </NUMBER_OF_SPECIES>\n')
+        f.write('    <SPECIE.1>\n      <ATOM_TYPE type="character" size="1" len="1">\nX\n      </ATOM_TYPE>\n'
+                '      <PSEUDO type="character" size="1" len="5">\nX.UPF\n      </PSEUDO>\n    </SPECIE.1>\n')
+        f.write('    <PSEUDO_DIR type="character" size="1" len="2">\n./\n    </PSEUDO_DIR>\n')
+        f.write('    <UNITS_FOR_ATOMIC_POSITIONS UNITS="Bohr"/>\n')
+        for i,tau in enumerate(np.dot(rng.rand(natoms,3),a_vectors)):
+            f.write('    <ATOM.{0:d} SPECIES="X" INDEX="1" tau="{1:s}" if_pos="1 1 1"/>\n'.format(
+                    i+1,' '.join(['{0:.15E}'.format(x) for x in tau])))
+        f.write('  </IONS>\n  <SYMMETRIES>\n')
+        for tag,val in [('NUMBER_OF_SYMMETRIES','1'),('NUMBER_OF_BRAVAIS_SYMMETRIES','1'),
+                        ('INVERSION_SYMMETRY','F'),('DO_NOT_USE_TIME_REVERSAL','T'),
+                        ('TIME_REVERSAL_FLAG','F'),('NO_TIME_REV_OPERATIONS','F')]:
+            f.write('    <{0:s}>\n {1:s}\n    </{0:s}>\n'.format(tag,val))
+        f.write('    <UNITS_FOR_SYMMETRIES UNITS="Crystal"/>\n    <SYMM.1>\n'
+                '      <ROTATION type="integer" size="9" columns="3">\n 1 0 0\n 0 1 0\n 0 0 1\n'
+                '      </ROTATION>\n    </SYMM.1>\n  </SYMMETRIES>\n')
+        f.write('  <PLANE_WAVES>\n    <FFT_GRID nr1="24" nr2="24" nr3="24"/>\n  </PLANE_WAVES>\n')
+        f.write('  <BRILLOUIN_ZONE>\n    <NUMBER_OF_K-POINTS type="integer" size="1">\n {0:d}\n'
+                '    </NUMBER_OF_K-POINTS>\n'.format(nkpnts))
+        for ik in range(nkpnts):
+            f.write('    <K-POINT.{0:d} XYZ="{1:s}" WEIGHT="{2:.15E}"/>\n'.format(
+                    ik+1,' '.join(['{0:.15E}'.format(x) for x in kpnts[ik]]),2.0/nkpnts))
+        f.write('  </BRILLOUIN_ZONE>\n  <BAND_STRUCTURE_INFO>\n')
+        f.write('    <NUMBER_OF_SPIN_COMPONENTS type="integer" size="1">\n {0:d}\n'
+                '    </NUMBER_OF_SPIN_COMPONENTS>\n'.format(nspin))
+        f.write('    <NUMBER_OF_BANDS type="integer" size="1">\n {0:d}\n    </NUMBER_OF_BANDS>\n'.format(nbnds))
+        f.write('    <UNITS_FOR_ENERGIES UNITS="Hartree"/>\n'
+                '    <FERMI_ENERGY type="real" size="1">\n 0.0\n    </FERMI_ENERGY>\n')
+        f.write('  </BAND_STRUCTURE_INFO>\n</Root>\n')
+def write_atomic_proj_xml(fname,kpnts,Hk,Sk,nbnds):
+    """
+    atomic_proj.xml of the model: eigenvalues E (Rydbergs) and projections
+    U = S^1/2 c of the S-orthonormal eigenvectors c; the nbnds-nawf extra
+    bands lie above the model bands and have no projections.
+    """
+    nkpnts,nspin,nawf,_ = Hk.shape
+    with open(fname,'w') as f:
+        f.write('<?xml version="1.0"?>\n<Root>\n  <HEADER>\n')
+        for tag,val in [('NUMBER_OF_BANDS',nbnds),('NUMBER_OF_K-POINTS',nkpnts),
+                        ('NUMBER_OF_SPIN_COMPONENTS',nspin),('NUMBER_OF_ATOMIC_WFC',nawf)]:
+            f.write('    <{0:s} type="integer" size="1">\n {1:d}\n    </{0:s}>\n'.format(tag,val))
+        f.write('    <UNITS_FOR_K-POINTS UNITS="2 pi / a"/>\n    <UNITS_FOR_ENERGY UNITS="Rydberg"/>\n'
+                '    <FERMI_ENERGY type="real" size="1">\n 0.0\n    </FERMI_ENERGY>\n  </HEADER>\n')
+        f.write('  <K-POINTS type="real" size="{0:d}" columns="3">\n'.format(3*nkpnts))
+        f.write(''.join([' %.15E %.15E %.15E\n' % tuple(k) for k in kpnts]))
+        f.write('  </K-POINTS>\n  <WEIGHT_OF_K-POINTS type="real" size="{0:d}">\n'.format(nkpnts))
+        f.write(format_block(np.ones(nkpnts)*2.0/nkpnts))
+        f.write('  </WEIGHT_OF_K-POINTS>\n')
+
+        eigs = np.zeros((nkpnts,nspin,nbnds))
+        U    = np.zeros((nkpnts,nspin,nawf,nbnds),dtype=complex)
+        eigS,vecS = np.linalg.eigh(Sk)
+        Shalf = np.matmul(vecS*np.sqrt(eigS)[:,None,:],np.conj(np.swapaxes(vecS,1,2)))
+        for ispin in range(nspin):
+            eigval,vec,_ = lib.eigh_gen_chol_1(Hk[:,ispin],Sk,eigvec=True)
+            eigs[:,ispin,:nawf] = eigval
+            eigs[:,ispin,nawf:] = np.max(eigval) + 1.0 + np.arange(nbnds-nawf)
+            U[:,ispin,:,:nawf]  = np.matmul(Shalf,vec)
+        eigs = eigs/lib.Ry2eV
+
+        f.write('  <EIGENVALUES>\n')
+        for ik in range(nkpnts):
+            f.write('    <K-POINT.{0:d}>\n'.format(ik+1))
+            for ispin in range(nspin):
+                tag = 'EIG' if nspin == 1 else 'EIG.{0:d}'.format(ispin+1)
+                f.write('      <{0:s} type="real" size="{1:d}">\n'.format(tag,nbnds))
+                f.write(format_block(eigs[ik,ispin]))
+                f.write('      </{0:s}>\n'.format(tag))
+            f.write('    </K-POINT.{0:d}>\n'.format(ik+1))
+        f.write('  </EIGENVALUES>\n  <PROJECTIONS>\n')
+        for ik in range(nkpnts):
+            f.write('    <K-POINT.{0:d}>\n'.format(ik+1))
+            for ispin in range(nspin):
+                if nspin > 1:
+                    f.write('      <SPIN.{0:d}>\n'.format(ispin+1))
+                for iawf in range(nawf):
+                    f.write('      <ATMWFC.{0:d} type="complex" size="{1:d}">\n'.format(iawf+1,nbnds))
+                    f.write(format_block(U[ik,ispin,iawf],'complex'))
+                    f.write('      </ATMWFC.{0:d}>\n'.format(iawf+1))
+                if nspin > 1:
+                    f.write('      </SPIN.{0:d}>\n'.format(ispin+1))
+            f.write('    </K-POINT.{0:d}>\n'.format(ik+1))
+        f.write('  </PROJECTIONS>\n  <OVERLAPS>\n')
+        for ik in range(nkpnts):
+            f.write('    <K-POINT.{0:d}>\n      <OVERLAP.1 type="complex" size="{1:d}">\n'.format(ik+1,nawf**2))
+            f.write(format_block(Sk[ik].ravel(order='F'),'complex'))
+            f.write('      </OVERLAP.1>\n    </K-POINT.{0:d}>\n'.format(ik+1))
+        f.write('  </OVERLAPS>\n</Root>\n')
+
+#stages: every one reads the files of the previous ones from case['dir']
+def stage_generate(case):
+    kpnts,Hk,Sk = make_model(case['nawf'],case['nspin'],case['grid'],case['seed'])
+    write_data_file_xml(case['data_file'],len(kpnts),case['nspin'],case['nbnds'],case['natoms'],kpnts,case['seed'])
+    write_atomic_proj_xml(case['atomic_proj'],kpnts,Hk,Sk,case['nbnds'])
+def stage_read_xml(case):
+    lib.read_QE_output_xml_v4(case['data_file'],case['QE_xml_data_file'],atomic_proj=case['atomic_proj'],
+                              read_eigs=True,read_U=True,read_S=True,nproc=case['nproc'],use_cache=False)
+def stage_build_Hk(case):
+    lib.build_Hk_5(case['QE_xml_data_file'],case['shift'],0,case['Hk_space'],case['Hk_file'],use_cache=False)
+def stage_WS_supercell(case):
+    lib.get_WS_supercell(case['grid'][0],case['grid'][1],case['grid'][2],a_vectors)
+def stage_build_HR(case):
+    nx,ny,nz = case['grid']
+    lib.build_HR_par_6(case['QE_xml_data_file'],case['HR_file'],case['Hk_file'],case['Hk_space'],
+                       nx=nx,ny=ny,nz=nz,nproc=case['nproc'],use_cache=False)
+def stage_bands(case):
+    lib.get_interpolated_bands_3(Kfrac,[case['nkpath']]*(len(Kfrac)-1),case['HR_file'])
+
+stages = [('generate',stage_generate),('read_QE_output_xml_v4',stage_read_xml),('build_Hk_5',stage_build_Hk),
+          ('get_WS_supercell',stage_WS_supercell),('build_HR_par_6',stage_build_HR),
+          ('get_interpolated_bands_3',stage_bands)]
+
+def maxrss_mb():
+    scale = 1024.0**2 if sys.platform == 'darwin' else 1024.0     #bytes on macOS, kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/scale
+def run_stage_child(func,case,queue):
+    sys.stdout = open(case['log'],'a')
+    rss0 = maxrss_mb()
+    tic  = time.time()
+    func(case)
+    queue.put({'time_s':time.time()-tic,'peak_rss_mb':maxrss_mb(),'peak_rss_delta_mb':maxrss_mb()-rss0})
+    sys.stdout.flush()
+def run_stage(func,case):
+    """
+    Runs func(case) in a child process; its peak memory does not mix with
+    that of the other stages. returns dictionary, None if the stage failed
+    """
+    queue = multiprocessing.Queue()
+    proc  = multiprocessing.Process(target=run_stage_child,args=(func,case,queue))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        return None
+    return queue.get()
+def git_revision():
+    try:
+        aux = subprocess.check_output(['git','rev-parse','HEAD'],cwd=os.path.dirname(os.path.abspath(__file__)))
+        return aux.decode('ascii').strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic benchmark of the PyTB pipeline stages')
+    parser.add_argument('--nawf',type=int,nargs='+',default=[8],help='orbitals per cell')
+    parser.add_argument('--nbnds',type=int,nargs='+',default=[],help='bands (default nawf+4)')
+    parser.add_argument('--grid',nargs='+',default=['4x4x4'],help='k-grids nx x ny x nz, e.g. 8x8x8')
+    parser.add_argument('--nspin',type=int,default=1)
+    parser.add_argument('--Hk_space',default='nonortho',choices=['ortho','nonortho'])
+    parser.add_argument('--nproc',type=int,default=1)
+    parser.add_argument('--nkpath',type=int,default=100,help='k-points per segment of the band path')
+    parser.add_argument('--atom_norb',type=int,default=4,help='orbitals per atom (atoms of data-file.xml)')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--workdir',default='bench_pipeline_data')
+    parser.add_argument('--keep',action='store_true',help='keep the generated files')
+    parser.add_argument('--json',default='bench_pipeline.json')
+    args = parser.parse_args()
+
+    results = {'date':time.strftime('%Y-%m-%dT%H:%M:%S'),'git_revision':git_revision(),
+               'python':platform.python_version(),'numpy':np.__version__,'platform':platform.platform(),
+               'cpu_count':multiprocessing.cpu_count(),'cases':[]}
+    for grid in args.grid:
+        grid = tuple([int(x) for x in grid.lower().split('x')])
+        if len(grid) != 3:
+            parser.error('--grid takes nx x ny x nz, e.g. 8x8x8')
+        for nawf in args.nawf:
+            for nbnds in (args.nbnds or [nawf+4]):
+                if nbnds < nawf:
+                    print('Skipping nawf = {0:d}, nbnds = {1:d}: nbnds < nawf'.format(nawf,nbnds))
+                    continue
+                name = 'nawf{0:d}_nbnds{1:d}_{2:d}x{3:d}x{4:d}'.format(nawf,nbnds,*grid)
+                wdir = os.path.abspath(os.path.join(args.workdir,name))
+                if not os.path.isdir(wdir):
+                    os.makedirs(wdir)
+                case = {'nawf':nawf,'nbnds':nbnds,'grid':grid,'nk':int(np.prod(grid)),'nspin':args.nspin,
+                        'Hk_space':args.Hk_space,'nproc':args.nproc,'nkpath':args.nkpath,'seed':args.seed,
+                        'natoms':max(nawf//args.atom_norb,1),'shift':1e3,'dir':wdir,
+                        'log':os.path.join(wdir,'bench.log'),
+                        'data_file':os.path.join(wdir,'data-file.xml'),
+                        'atomic_proj':os.path.join(wdir,'atomic_proj.xml'),
+                        'QE_xml_data_file':os.path.join(wdir,'QE_xml_data.npz'),
+                        'Hk_file':os.path.join(wdir,'Hk.npz'),'HR_file':os.path.join(wdir,'HR.npz')}
+
+                print('{0:s}:'.format(name))
+                entry = dict([(key,case[key]) for key in ['nawf','nbnds','grid','nk','nspin','Hk_space','nproc',
+                                                           'nkpath']])
+                entry['stages'] = {}
+                for label,func in stages:
+                    aux = run_stage(func,case)
+                    if aux is None:
+                        print('  {0:25s}: failed, see {1:s}'.format(label,case['log']))
+                        entry['stages'][label] = {'error':True}
+                        break
+                    entry['stages'][label] = aux
+                    print('  {0:25s}: {1:9.3f} s  peak {2:9.1f} MB  (+{3:.1f} MB)'.format(
+                          label,aux['time_s'],aux['peak_rss_mb'],aux['peak_rss_delta_mb']))
+                    if label == 'generate':
+                        entry['atomic_proj_mb'] = os.path.getsize(case['atomic_proj'])/1024.0**2
+                results['cases'].append(entry)
+                if not args.keep:
+                    shutil.rmtree(wdir)
+
+    with open(args.json,'w') as f:
+        json.dump(results,f,indent=1)
+    print('Results saved in {0:s}'.format(args.json))
@@ -78,5 +78,5 @@ W= [0.750, 0.500, 0.250]
 Kfrac = [G,X,W,L,G,K,W]
 nkmesh= 6*[50] #number of segments * number of points per segment
 
-lib.get_interpolated_bands_3(Kfrac,nkmesh,HR_outfile,Erange)
+lib.get_interpolated_bands_3(Kfrac,nkmesh,HR_outfile,Erange,bands_text=True)  #bands_nonortho_ws.txt for plot.gnu
 
@@ -0,0 +1,285 @@
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+import numpy.linalg as la
+import sys
+from math import factorial
+from scipy.special import erf, eval_hermite
+
+import lib_utils as utils
+import lib_pytb as lib
+
+Bohr2cm = 0.52917721067e-8
+
+#the 6 tetrahedra of a cube sharing the 0-7 diagonal; corner = 4*dx+2*dy+dz
+tetra_corners = np.array([[0,1,3,7],[0,1,5,7],[0,2,3,7],[0,2,6,7],[0,4,5,7],[0,4,6,7]])
+
+def tetra_idos_1(e,E):
+    """
+    Linear-tetrahedron integrated DOS (Bloechl, without corrections) of one
+    band in one tetrahedron, normalized to 1.
+    e[4,n]: corner energies sorted in ascending order, E[n]: energies
+    returns N[n]
+    """
+    e1,e2,e3,e4 = e
+    d21 = np.maximum(e2-e1,1e-12)
+    d31 = np.maximum(e3-e1,1e-12)
+    d41 = np.maximum(e4-e1,1e-12)
+    d32 = np.maximum(e3-e2,1e-12)
+    d42 = np.maximum(e4-e2,1e-12)
+    d43 = np.maximum(e4-e3,1e-12)
+
+    N  = np.where(E >= e4,1.0,0.0)
+    i1 = np.logical_and(E >= e1,E < e2)
+    i2 = np.logical_and(E >= e2,E < e3)
+    i3 = np.logical_and(E >= e3,E < e4)
+    x  = E-e1
+    N[i1] = (x**3/(d21*d31*d41))[i1]
+    x  = E-e2
+    N[i2] = ((d21**2 + 3*d21*x + 3*x**2 - (d31+d42)/(d32*d42)*x**3)/(d31*d41))[i2]
+    x  = e4-E
+    N[i3] = (1 - x**3/(d41*d42*d43))[i3]
+    return N
+def smearing_idos_1(x,order=0):
+    """
+    Integrated smeared delta function at x=(E-e)/sigma: Gaussian (order=0)
+    or Methfessel-Paxton of the given order,
+        theta_N(x) = (1+erf(x))/2 - sum_n A_n H_2n-1(x) exp(-x^2),
+        A_n = (-1)^n/(n! 4^n sqrt(pi))
+    """
+    N = 0.5*(1+erf(x))
+    for n in range(1,order+1):
+        A  = (-1)**n/(factorial(n)*4**n*np.sqrt(np.pi))
+        N -= A*eval_hermite(2*n-1,x)*np.exp(-x**2)
+    return N
+def accumulate_idos_1(idos,edges,e_lo,e_hi,func,weight):
+    """
+    Adds weight*N_i(edges) to idos for a set of states i whose integrated
+    DOS N_i goes from 0 below e_lo[i] to 1 above e_hi[i]. Only the edges
+    in [e_lo,e_hi) are evaluated, with func(i,E) -> N_i(E); the rest is a
+    step added through a cumulative sum. idos[nedges] is updated in place.
+    weight: a number, or one weight per state (projected DOS)
+    """
+    nedges = len(edges)
+    weight = np.broadcast_to(weight,np.shape(e_lo))
+    i_lo   = np.searchsorted(edges,e_lo)
+    i_hi   = np.searchsorted(edges,e_hi)
+    idos  += np.cumsum(np.bincount(i_hi,weights=weight,minlength=nedges+1)[:nedges])
+
+    count  = i_hi-i_lo
+    item   = np.repeat(np.arange(len(e_lo)),count)
+    if len(item) == 0:
+        return
+    iedge  = i_lo[item] + np.arange(len(item)) - np.repeat(np.cumsum(count)-count,count)
+    idos  += np.bincount(iedge,weights=weight[item]*func(item,edges[iedge]),minlength=nedges)
+def get_kplane_1(i1,nk1,nk2,nk3,b_vectors):
+    """
+    k-points of the plane i1 of the regular nk1 x nk2 x nk3 grid, ordered
+    as (i2,i3), in the units of b_vectors
+    """
+    i2,i3 = np.meshgrid(np.arange(nk2),np.arange(nk3),indexing='ij')
+    kfrac = np.column_stack((np.ones(nk2*nk3)*i1/nk1,i2.ravel()/nk2,i3.ravel()/nk3))
+    return np.dot(kfrac,b_vectors)
+@utils.profile_stage('get_dos_1')
+def get_dos_1(HR_mat_path,nk1,nk2,nk3,emin,emax,nE=2000,method='tetra',sigma=0.05,mp_order=1,
+              nelec=None,nelec0=None,kT=0.0,k_block_size=1000,dos_outfile='',groups=None,
+              proj_method='mulliken'):
+    """
+    Density of states of the H(R) model on a dense nk1 x nk2 x nk3 mesh.
+    The mesh is diagonalized one plane (nk2*nk3 k-points) at a time and
+    every plane is accumulated into the integrated DOS N(E) on the nE+1
+    bin edges of [emin,emax] (eV), so the eigenvalues of the whole mesh are
+    never stored. States below emin are counted in N(E).
+    method: 'tetra'    = linear tetrahedron (two neighbouring planes in memory)
+            'gaussian' = Gaussian smearing of width sigma (eV)
+            'mp'       = Methfessel-Paxton smearing of order mp_order
+    nelec:  number of electrons per cell, for the Fermi level
+    nelec0: number of electrons of the neutral cell; with nelec, gives the
+            electron and hole densities (get_carrier_densities_1)
+    kT:     temperature (eV) of the Fermi-Dirac occupations (0: T=0)
+    dos_outfile: optional text file with E, DOS and N(E) per spin
+    groups: group index of every orbital (lib_pytb.get_orbital_groups_1);
+            if given, the DOS projected on the groups is accumulated in the
+            same pass from the proj_method ('mulliken' or 'lowdin') weights
+            of the states (in 'tetra', the mean of the 4 corners)
+    returns dictionary with energies[nE] (bin centers), dos[nE,nspin]
+            (states/eV/cell, including the spin degeneracy), edges[nE+1],
+            idos[nE+1,nspin], Efermi, and electron_density and
+            hole_density (cm^-3) and the neutral gap edges E_vbm, E_cbm (or None),
+            and with groups pdos[nE,nspin,ngroups] and pidos[nE+1,nspin,ngroups]
+    """
+    fname  = utils.fname()
+    method = method.lower()
+    if method not in ['tetra','gaussian','mp']:
+        sys.exit('{0:s}: Value of method not recognized'.format(fname))
+
+    model  = lib.TBModel(HR_mat_path)
+    nspin  = model.nspin
+    nawf   = model.nawf
+    nktot  = nk1*nk2*nk3
+    edges  = np.linspace(emin,emax,nE+1)
+    idos   = np.zeros((nE+1,nspin))
+    nbad   = 0
+    ngroups= 0 if groups is None else np.max(groups)+1
+    pidos  = np.zeros((nE+1,nspin,ngroups))
+
+    if method == 'mp':
+        order = mp_order
+    else:
+        order = 0
+    xmax   = 7.0 + 2*order
+
+    def get_plane(i1):
+        kplane = get_kplane_1(i1 % nk1,nk1,nk2,nk3,np.eye(3))
+        if groups is None:
+            Ek,_,_,report = model.eig(kplane,k_block_size=k_block_size)
+            W = np.zeros((nk2,nk3,nawf,nspin,0))
+        else:
+            Ek,W,report = model.eig_proj(kplane,groups,method=proj_method,k_block_size=k_block_size)
+            W = np.transpose(W,(0,2,1,3)).reshape((nk2,nk3,nawf,nspin,ngroups))
+        return np.transpose(Ek,(0,2,1)).reshape((nk2,nk3,nawf,nspin)),W,np.sum(~report['positive'])
+
+    utils.set_profile_info_1(method=method,nk=nktot,nawf=nawf,nspin=nspin,nE=nE)
+    plane0,W0,nbad = get_plane(0)
+    plane,W = plane0,W0
+    for i1 in range(nk1):
+        if method == 'tetra':
+            if i1 == nk1-1:
+                plane_next,W_next = plane0,W0
+            else:
+                plane_next,W_next,aux = get_plane(i1+1)
+                nbad += aux
+            #corner energies [8,ncubes,nawf,nspin] and weights [8,ncubes,nawf,nspin,ngroups]
+            corners   = []
+            corners_W = []
+            for P,PW in [(plane,W),(plane_next,W_next)]:
+                for dy in range(2):
+                    for dz in range(2):
+                        corners.append(np.roll(np.roll(P,-dy,axis=0),-dz,axis=1).reshape((nk2*nk3,nawf,nspin)))
+                        corners_W.append(np.roll(np.roll(PW,-dy,axis=0),-dz,axis=1).reshape(
+                                         (nk2*nk3,nawf,nspin,ngroups)))
+            corners   = np.array(corners)
+            corners_W = np.array(corners_W)
+            with utils.profile_step('accumulate'):
+                for ispin in range(nspin):
+                    e = np.sort(corners[tetra_corners,:,:,ispin],axis=1)    #[6,4,ncubes,nawf]
+                    e = np.transpose(e,(1,0,2,3)).reshape((4,-1))
+                    func = lambda item,E: tetra_idos_1(e[:,item],E)
+                    accumulate_idos_1(idos[:,ispin],edges,e[0],e[3],func,1.0/(6*nktot))
+                    if ngroups == 0:
+                        continue
+                    w = np.mean(corners_W[tetra_corners,:,:,ispin,:],axis=1).reshape((-1,ngroups))
+                    for igroup in range(ngroups):
+                        accumulate_idos_1(pidos[:,ispin,igroup],edges,e[0],e[3],func,w[:,igroup]/(6*nktot))
+            plane,W = plane_next,W_next
+        else:
+            if i1 > 0:
+                plane,W,aux = get_plane(i1)
+                nbad += aux
+            with utils.profile_step('accumulate'):
+                for ispin in range(nspin):
+                    e = plane[:,:,:,ispin].ravel()
+                    func = lambda item,E: smearing_idos_1((E-e[item])/sigma,order)
+                    accumulate_idos_1(idos[:,ispin],edges,e-xmax*sigma,e+xmax*sigma,func,1.0/nktot)
+                    if ngroups == 0:
+                        continue
+                    w = W[:,:,:,ispin,:].reshape((-1,ngroups))
+                    for igroup in range(ngroups):
+                        accumulate_idos_1(pidos[:,ispin,igroup],edges,e-xmax*sigma,e+xmax*sigma,func,
+                                          w[:,igroup]/nktot)
+
+    idos    = idos*2/nspin
+    pidos   = pidos*2/nspin
+    dos     = np.diff(idos,axis=0)/(edges[1]-edges[0])
+    energies= 0.5*(edges[1:]+edges[:-1])
+
+    print('{0:s}: DOS ({1:s}) on a {2:d}x{3:d}x{4:d} mesh'.format(fname,method,nk1,nk2,nk3))
+    if nbad > 0:
+        print('{0:s}: Sk not positive definite at {1:d} k-points'.format(fname,nbad))
+
+    Efermi = None
+    carriers = {'electron_density':None,'hole_density':None,'E_vbm':None,'E_cbm':None}
+    if nelec is not None:
+        Efermi = get_fermi_level_1(edges,np.sum(idos,axis=1),nelec,kT)
+        print('{0:s}: Efermi = {1:f} eV for {2:f} electrons'.format(fname,Efermi,nelec))
+        if nelec0 is not None:
+            volume = abs(la.det(model.a_vectors))*Bohr2cm**3
+            n_e,n_h,E_vbm,E_cbm = get_carrier_densities_1(edges,np.sum(idos,axis=1),nelec0,Efermi,kT)
+            carriers = {'electron_density':n_e/volume,'hole_density':n_h/volume,'E_vbm':E_vbm,'E_cbm':E_cbm}
+            print('{0:s}: gap [{1:f},{2:f}] eV, electrons {3:e} cm^-3, holes {4:e} cm^-3'.format(
+                  fname,E_vbm,E_cbm,n_e/volume,n_h/volume))
+
+    if dos_outfile:
+        header = 'E(eV) ' + ' '.join(['DOS_{0:d}'.format(i) for i in range(nspin)]) + ' ' + \
+                 ' '.join(['N_{0:d}'.format(i) for i in range(nspin)])
+        if Efermi is not None:
+            header += '\nEfermi = {0:f} eV'.format(Efermi)
+        np.savetxt(dos_outfile,np.column_stack((energies,dos,0.5*(idos[1:]+idos[:-1]))),fmt='%14.8f',
+                   header=header)
+        print('{0:s}: Saving data in {1:s}'.format(fname,dos_outfile))
+
+    out = {'energies':energies,'dos':dos,'edges':edges,'idos':idos,'Efermi':Efermi}
+    out.update(carriers)
+    if groups is not None:
+        out['pdos']  = np.diff(pidos,axis=0)/(edges[1]-edges[0])
+        out['pidos'] = pidos
+    return out
+def fermi_dirac_1(E,mu,kT):
+    """
+    Fermi-Dirac occupation of the energies E at chemical potential mu and
+    temperature kT (eV); a step function for kT=0
+    """
+    if kT <= 0:
+        return (E < mu) + 0.5*(E == mu)
+    return 0.5*(1-np.tanh(0.5*(E-mu)/kT))
+def get_fermi_level_1(edges,idos,nelec,kT=0.0):
+    """
+    Energy at which the total integrated DOS idos[nedges] reaches nelec,
+    linearly interpolated between the bin edges. With kT > 0 (eV), the
+    chemical potential of nelec electrons with Fermi-Dirac occupations
+    of the bins (bisection).
+    """
+    fname = utils.fname()
+    if nelec <= idos[0] or nelec > idos[-1]:
+        sys.exit('{0:s}: {1:f} electrons are outside [{2:f},{3:f}]; widen the energy range'.format(
+                 fname,nelec,idos[0],idos[-1]))
+    if kT > 0:
+        dN = np.diff(idos)
+        E  = 0.5*(edges[1:]+edges[:-1])
+        lo,hi = edges[0],edges[-1]
+        for it in range(100):
+            mu = 0.5*(lo+hi)
+            if idos[0]+np.sum(dN*fermi_dirac_1(E,mu,kT)) < nelec:
+                lo = mu
+            else:
+                hi = mu
+        return 0.5*(lo+hi)
+    i = np.where(idos >= nelec)[0][0]
+    if idos[i] == idos[i-1]:
+        return edges[i]
+    return edges[i-1] + (nelec-idos[i-1])/(idos[i]-idos[i-1])*(edges[i]-edges[i-1])
+def get_carrier_densities_1(edges,idos,nelec0,Efermi,kT=0.0,tol=1e-6):
+    """
+    Electron and hole numbers per cell from the total integrated DOS
+    idos[nedges]. The nelec0 electrons of the neutral cell fill the states up
+    to the gap [E_vbm,E_cbm], where idos stays at nelec0 within tol
+    (E_vbm = E_cbm = neutral Fermi level for a metal). The electrons are the
+    occupied states above the middle of the gap and the holes the empty
+    states below it, with Fermi-Dirac occupations at Efermi and kT (eV).
+    returns n_e, n_h, E_vbm, E_cbm
+    """
+    E0 = get_fermi_level_1(edges,idos,nelec0)
+    i_v = np.where(idos >= nelec0-tol)[0][0]
+    i_c = np.where(idos <= nelec0+tol)[0][-1]
+    if i_c > i_v:
+        E_vbm,E_cbm = edges[i_v],edges[i_c]
+    else:
+        E_vbm,E_cbm = E0,E0
+
+    dN  = np.diff(idos)
+    E   = 0.5*(edges[1:]+edges[:-1])
+    occ = fermi_dirac_1(E,Efermi,kT)
+    Emid = 0.5*(E_vbm+E_cbm)
+    n_e = np.sum((dN*occ)[E > Emid])
+    n_h = np.sum((dN*(1-occ))[E < Emid])
+    return n_e,n_h,E_vbm,E_cbm
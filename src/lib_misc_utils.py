@@ -1,10 +1,12 @@
 from __future__ import division
-from StringIO import StringIO
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 import numpy as np
 import xml.etree.ElementTree as et
 import os
 import sys
-import matplotlib.pyplot as plt
 
 def read_gnuplot_data(filename,sep_str='\n \n'):
 
@@ -27,21 +29,5 @@ def read_gnuplot_data(filename,sep_str='\n \n'):
 
   return bands
 def plot_gnuplot_data(filename,Ef=0,ymin=-10,ymax=10):
-    bands = read_gnuplot_data(filename,sep_str='\n \n')
-
-    nbnds = len(bands)
-    fig=plt.figure()
-    
-    for i in range(nbnds):
-          x = bands[i][:,0]
-          y = bands[i][:,1]
-          plt.plot(range(len(x)),y,'.-',linewidth=0.1)
-
-    plt.xlabel('k-points')
-    plt.ylabel('Energy - E$_F$ (eV)')
-
-    plt.gca().grid(True)
-    plt.ylim(ymin,ymax)
-    pdffile = 'eraseplot.pdf'
-    print('plot_gnuplot_data: printing to eraseplot.pdf')
-    plt.savefig(pdffile,format='pdf')
+    import lib_plot
+    lib_plot.plot_gnuplot_data(filename,Ef=Ef,ymin=ymin,ymax=ymax)
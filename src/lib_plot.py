@@ -0,0 +1,84 @@
+"""
+Plotting of lib_pytb and lib_misc_utils. This is the only module that
+imports matplotlib; band_plot_3, plot_gnuplot_data and
+plot_compare_TB_DFT_eigs import it when they run, so the compute API
+loads with numpy and scipy only.
+"""
+from __future__ import print_function
+from __future__ import division
+import sys
+import numpy as np
+import numpy.linalg as la
+import matplotlib
+if 'matplotlib.pyplot' not in sys.modules:
+    matplotlib.use('Agg')   #the figures are only saved to files
+import matplotlib.pyplot as plt
+
+import lib_misc_utils as mutils
+
+def plot_bands_1(Ek,pdffile,erange=[-20,10]):
+    """
+    Figure of the bands Ek[nbnds,nk] (one spin channel) against the k-point
+    index, saved to pdffile
+    """
+    fig=plt.figure()
+    plt.plot(np.transpose(Ek),'.-',linewidth=0.1)
+
+    plt.xlabel('k-points')
+    plt.ylabel('Energy - E$_F$ (eV)')
+    plt.ylim(erange[0],erange[1])
+
+    plt.gca().grid(True)
+    plt.savefig(pdffile,format='pdf')
+    plt.close(fig)
+def plot_gnuplot_data(filename,Ef=0,ymin=-10,ymax=10):
+    bands = mutils.read_gnuplot_data(filename,sep_str='\n \n')
+
+    nbnds = len(bands)
+    fig=plt.figure()
+
+    for i in range(nbnds):
+          x = bands[i][:,0]
+          y = bands[i][:,1]
+          plt.plot(range(len(x)),y,'.-',linewidth=0.1)
+
+    plt.xlabel('k-points')
+    plt.ylabel('Energy - E$_F$ (eV)')
+
+    plt.gca().grid(True)
+    plt.ylim(ymin,ymax)
+    pdffile = 'eraseplot.pdf'
+    print('plot_gnuplot_data: printing to eraseplot.pdf')
+    plt.savefig(pdffile,format='pdf')
+def plot_compare_TB_DFT_eigs(Hks,my_eigsmat):
+
+    nawf,nawf,nkpnts,nspin = Hks.shape
+    nbnds_tb = nawf
+    E_k = np.zeros((nbnds_tb,nkpnts,nspin))
+
+    ispin = 0 #plots only 1 spin channel
+    for ik in range(nkpnts):
+        eigval,_ = la.eig(Hks[:,:,ik,ispin])
+        E_k[:,ik,ispin] = np.sort(np.real(eigval))
+
+    fig=plt.figure
+    nbnds_dft,_,_=my_eigsmat.shape
+    for i in range(nbnds_dft):
+        yy = my_eigsmat[i,:,ispin]
+        if i==0:
+          plt.plot(yy,'-',linewidth=3,color='lime',label='DFT')
+        else:
+          plt.plot(yy,'-',linewidth=3,color='lime')
+
+    for i in range(nbnds_tb):
+        yy = E_k[i,:,ispin]
+        if i==0:
+          plt.plot(yy,'ok',markersize=2,markeredgecolor='None',label='TB')
+        else:
+          plt.plot(yy,'ok',markersize=2,markeredgecolor='None')
+
+    plt.xlabel('k-points')
+    plt.ylabel('Energy - E$_F$ (eV)')
+    plt.legend()
+    plt.title('Comparison of TB vs. DFT eigenvalues')
+    plt.savefig('comparison.pdf',format='pdf')
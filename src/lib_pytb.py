@@ -1,6 +1,7 @@
 from __future__ import print_function
 from __future__ import division
 from scipy import linalg as sla
+from scipy import sparse as sps
 from functools import partial
 import multiprocessing
 import numpy as np
@@ -9,14 +10,9 @@ import numpy.linalg as la
 import sys
 import re
 import os
-import time
-import datetime
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+import hashlib
 
 import lib_utils as utils
-import lib_misc_utils as mutils
 
 
 
@@ -30,9 +26,9 @@ def build_HR_3(ineigh,neigh_indx_3d,nkpnts,kpnts,kpnts_wght,alat,a_vectors,nawf,
     else:
         is_wannier=False
 
-    H = np.zeros((nawf,nawf),dtype=np.complex_)
+    H = np.zeros((nawf,nawf),dtype=complex)
     if not is_wannier:
-        S = np.zeros((nawf,nawf),dtype=np.complex_)
+        S = np.zeros((nawf,nawf),dtype=complex)
 
     R = np.dot(neigh_indx_3d[ineigh],a_vectors)
 
@@ -49,8 +45,177 @@ def build_HR_3(ineigh,neigh_indx_3d,nkpnts,kpnts,kpnts_wght,alat,a_vectors,nawf,
         S = S/np.sum(kpnts_wght)
 
     return H,S
+def build_HR_gemm_1(irvec,kpnts,kpnts_wght,alat,a_vectors,Hk,Sk,block_size=0):
+    """
+    Batched H(k) -> H(R) transform for all R-vectors and spin channels.
+    For each block of R-vectors the phase matrix
+        P[iR,ik] = w_k*exp(-i K_k.R_iR)/sum(w)
+    is built once, and H(R) (and S(R)) for the whole block is obtained with
+    one matrix product per spin channel: [nawf**2 x nk] x [nk x nR_block].
+    block_size: number of R-vectors per block (caps the memory of the phase
+                matrix and of the intermediate products). 0 = all at once.
+    returns HR_mat[nspin,nR,nmatrices,nawf,nawf]; nmatrices=1 if Sk is None
+    """
+    nawf   = Hk.shape[0]
+    nkpnts = Hk.shape[2]
+    nspin  = Hk.shape[3]
+    nneighs= len(irvec)
+
+    if Sk is None:
+        nmatrices = 1
+    else:
+        nmatrices = 2
+
+    if block_size <= 0:
+        block_size = nneighs
+
+    Rarray = np.dot(irvec,a_vectors)             #in Bohrs
+    Karray = 2*np.pi/alat*np.asarray(kpnts)      #in 1/Bohrs
+    wk     = np.asarray(kpnts_wght)/np.sum(kpnts_wght)
+
+    Hk_flat = Hk.reshape((nawf*nawf,nkpnts,nspin))
+    if Sk is not None:
+        Sk_flat = Sk.reshape((nawf*nawf,nkpnts))
+
+    HR_mat = np.zeros((nspin,nneighs,nmatrices,nawf,nawf),dtype=complex)
+
+    for ir0 in range(0,nneighs,block_size):
+        ir1   = min(ir0+block_size,nneighs)
+        phase = wk[None,:]*np.exp(-1j*np.dot(Rarray[ir0:ir1,:],Karray.T)) #nR_block x nk
+        for ispin in range(nspin):
+            aux = np.dot(Hk_flat[:,:,ispin],phase.T)
+            HR_mat[ispin,ir0:ir1,0,:,:] = aux.T.reshape((ir1-ir0,nawf,nawf))
+        if Sk is not None:
+            aux = np.dot(Sk_flat,phase.T).T.reshape((ir1-ir0,nawf,nawf))
+            for ispin in range(nspin):
+                HR_mat[ispin,ir0:ir1,1,:,:] = aux
+
+    return HR_mat
+def build_HR_shm_block_1(ir_range,shared,irvec,kpnts_wght,alat,a_vectors,HR_method,block_size=0):
+    """
+    Worker of the multiprocessing path of build_HR_par_6. Attaches the
+    shared Hk, Sk, kpnts and HR_mat arrays (utils.attach_shared_array_1) and
+    writes H(R) for the R-vectors ir_range=(ir0,ir1) in place, with
+    build_HR_gemm_1 (HR_method='gemm') or build_HR_3 (HR_method='direct').
+    returns utils.profile_worker stats of the task
+    """
+    clock   = utils.profile_worker()
+    ir0,ir1 = ir_range
+    Hk      = utils.attach_shared_array_1(shared['Hk'],mode='r')
+    kpnts   = utils.attach_shared_array_1(shared['kpnts'],mode='r')
+    HR_mat  = utils.attach_shared_array_1(shared['HR_mat'])
+    if 'Sk' in shared:
+        Sk  = utils.attach_shared_array_1(shared['Sk'],mode='r')
+    else:
+        Sk  = None
+
+    if HR_method == 'gemm':
+        HR_mat[:,ir0:ir1,...] = build_HR_gemm_1(irvec[ir0:ir1],kpnts,kpnts_wght,alat,a_vectors,Hk,Sk,
+                                                block_size=block_size)
+    else:
+        nawf   = Hk.shape[0]
+        nkpnts = Hk.shape[2]
+        for ispin in range(Hk.shape[3]):
+            for ir in range(ir0,ir1):
+                Haux,Saux = build_HR_3(ir,irvec,nkpnts,kpnts,kpnts_wght,alat,a_vectors,nawf,ispin,Hk,Sk)
+                HR_mat[ispin,ir,0,:,:] = Haux
+                if Sk is not None:
+                    HR_mat[ispin,ir,1,:,:] = Saux
+    HR_mat.flush()
+    return clock.stats(nR=ir1-ir0)
+def get_kgrid_index(kpnts,kpnts_wght,alat,a_vectors,nx,ny,nz,eps=1e-6):
+    """
+    Maps each k-point to its index (i1,i2,i3) on the regular, unshifted
+    nx x ny x nz Monkhorst-Pack grid, k = i1/nx b1 + i2/ny b2 + i3/nz b3.
+    kpnts are cartesian, in units of 2pi/alat.
+    returns kgrid_index[nkpnts,3], or None if the k-points (or their weights)
+    do not cover the full uniform grid exactly once.
+    """
+    nkpnts = len(kpnts)
+    if nx*ny*nz != nkpnts:
+        return None
+    kpnts_wght = np.asarray(kpnts_wght)
+    if np.any(np.abs(kpnts_wght-kpnts_wght[0]) > eps*np.abs(kpnts_wght[0])):
+        return None
+
+    nk    = np.array([nx,ny,nz])
+    kfrac = np.dot(kpnts,np.transpose(a_vectors))/alat   #crystal coordinates
+    aux   = kfrac*nk
+    kint  = np.rint(aux).astype(int)
+    if np.any(np.abs(aux-kint) > eps):
+        return None
+
+    kgrid_index = np.mod(kint,nk)
+    iflat = np.ravel_multi_index(kgrid_index.T,(nx,ny,nz))
+    if len(np.unique(iflat)) != nkpnts:
+        return None
+
+    return kgrid_index
+def build_HR_fft_1(irvec,kgrid_index,nx,ny,nz,Hk,Sk):
+    """
+    H(k) -> H(R) for a regular unshifted k-grid (see get_kgrid_index).
+    H(k) is placed on the nx x ny x nz grid and transformed with one 3D FFT
+    per orbital pair; H(R) is then read off at R mod (nx,ny,nz) for every
+    R-vector in irvec (e.g. the Wigner-Seitz vectors from get_WS_supercell).
+    returns HR_mat[nspin,nR,nmatrices,nawf,nawf]; nmatrices=1 if Sk is None
+    """
+    nawf   = Hk.shape[0]
+    nspin  = Hk.shape[3]
+    nneighs= len(irvec)
+    ngrid  = nx*ny*nz
+
+    if Sk is None:
+        nmatrices = 1
+    else:
+        nmatrices = 2
+
+    i1,i2,i3 = kgrid_index.T
+    r1,r2,r3 = np.mod(np.asarray(irvec),[nx,ny,nz]).T
+
+    HR_mat = np.zeros((nspin,nneighs,nmatrices,nawf,nawf),dtype=complex)
+    aux    = np.zeros((nawf,nawf,nx,ny,nz),dtype=complex)
+
+    for ispin in range(nspin):
+        aux[:,:,i1,i2,i3] = Hk[:,:,:,ispin]
+        HR_aux = np.fft.fftn(aux,axes=(2,3,4))/ngrid
+        HR_mat[ispin,:,0,:,:] = np.transpose(HR_aux[:,:,r1,r2,r3],(2,0,1))
+
+    if Sk is not None:
+        aux[:,:,i1,i2,i3] = Sk
+        SR_aux = np.transpose(np.fft.fftn(aux,axes=(2,3,4))[:,:,r1,r2,r3],(2,0,1))/ngrid
+        for ispin in range(nspin):
+            HR_mat[ispin,:,1,:,:] = SR_aux
+
+    return HR_mat
+@utils.profile_stage('build_HR_par_6')
 def build_HR_par_6(QE_xml_data_file,HR_file,Hk_file,Hk_space,
-                   WS_supercell_file='',nx=0,ny=0,nz=0,nproc=1):
+                   WS_supercell_file='',nx=0,ny=0,nz=0,nproc=1,
+                   HR_method='fft',HR_block_size=256,WS_cache_dir='',use_cache=True,
+                   HR_sparse_file='',atom_norb=None,dist_cutoff=0.0,norm_cutoff=0.0,
+                   HR_compact=False,real_tol=1e-8):
+    """
+    HR_method: 'fft'    = if kpnts cover the regular nx x ny x nz grid,
+                          one 3D FFT per orbital pair (build_HR_fft_1);
+                          otherwise falls back to 'gemm'.
+               'gemm'   = batched phase-matrix products for all R-vectors and
+                          spins (build_HR_gemm_1), in blocks of HR_block_size
+                          R-vectors.
+               'direct' = one build_HR_3 call per R-vector.
+               With nproc > 1, 'gemm' and 'direct' run on a pool of nproc
+               processes that share Hk, Sk, kpnts and HR_mat through
+               memory-mapped files (build_HR_shm_block_1).
+    WS_cache_dir: directory for the on-disk cache of get_WS_supercell.
+    use_cache: skip the calculation if HR_file was built from the same
+               inputs and parameters (see utils.check_stage_cache_1).
+    HR_sparse_file: if given, also saves the atom-pair block-sparse H(R)
+               (see save_HR_sparse_1), with atom_norb orbitals per atom and
+               the dist_cutoff/norm_cutoff truncation.
+    HR_compact: stores only R=0 and one R of every (R,-R) pair, since
+               H(-R)=H(R)^H (get_half_Rvectors_1); only those H(R) are
+               computed. With time-reversal symmetry H(R) and S(R) are real
+               and are stored as float if max|Im H(R)| < real_tol.
+               returns the compact HR_mat, irvec_Re and w_Re in that case.
+    """
     
 
     from multiprocessing import Pool
@@ -59,21 +224,40 @@ def build_HR_par_6(QE_xml_data_file,HR_file,Hk_file,Hk_space,
     if not os.path.isdir(HR_file_dir): 
        print('{0:s}: Directory {1:s} does not exist. Attempting to create it'.format(fname,HR_file_dir) ) 
        os.makedirs(HR_file_dir)
-    if not os.path.isfile(QE_xml_data_file):
+    if not os.path.exists(QE_xml_data_file):
         sys.exit('{0:s}: QE_xml_data_file does not exist.'.format(fname) )
-    if not os.path.isfile(Hk_file): 
+    if not os.path.exists(Hk_file): 
         sys.exit('{0:s}: Hk_file/Uk_file does not exist.'.format(fname) )
 
     if (not WS_supercell_file) and (nx*ny*nz == 0): 
         sys.exit('{0:s}: Wrong values for nx,ny,nz'.format(fname) )
+
+    stage_inputs = [QE_xml_data_file,Hk_file]
+    if WS_supercell_file:
+        stage_inputs.append(WS_supercell_file)
+    if Hk_space.lower() == 'wannier' and os.path.isfile(os.path.join(os.path.dirname(Hk_file),'eig.npy')):
+        stage_inputs.append(os.path.join(os.path.dirname(Hk_file),'eig.npy'))
+    stage_params = {'Hk_space':Hk_space.lower(),'nx':nx,'ny':ny,'nz':nz,'HR_compact':HR_compact,
+                    'real_tol':real_tol,'HR_method':HR_method.lower()}
+    stage_digest = utils.stage_hash_1(fname,stage_inputs,stage_params)
+    if utils.check_stage_cache_1(fname,HR_file,stage_digest,use_cache=use_cache):
+        aux = utils.load_data_1(HR_file)
+        if HR_sparse_file:
+            save_HR_sparse_1(HR_file,QE_xml_data_file,HR_sparse_file,atom_norb,
+                             dist_cutoff=dist_cutoff,norm_cutoff=norm_cutoff,use_cache=use_cache)
+        return aux['HR_mat'],aux['irvec_Re'],aux['w_Re']
     
-    data      = np.load(QE_xml_data_file)
+    data      = utils.load_data_1(QE_xml_data_file)
     alat      = data['alat']
     a_vectors = data['a_vectors']
     nkpnts    = int(data['nkpnts'])
     nspin     = int(data['nspin'])
     kpnts     = data['kpnts']
     kpnts_wght= data['kpnts_wght']
+    if 'time_reversal' in data:
+        time_reversal = bool(data['time_reversal'])
+    else:
+        time_reversal = False
    
     Hk_space = Hk_space.lower()
 
@@ -107,7 +291,7 @@ def build_HR_par_6(QE_xml_data_file,HR_file,Hk_file,Hk_space,
     elif (Hk_space == 'ortho') or (Hk_space == 'nonortho'):
         nawf_      = int(data['nawf'])
         is_wannier = False
-        Hk = np.load(Hk_file)['Hk']
+        Hk = utils.load_data_1(Hk_file)['Hk']
         nawf    = Hk.shape[0]
         if nawf != nawf_:
             print('WARNING!!, mismatch nawf in xml is {0:d}, while nawf in Hk is {1:d}'.format(nawf_,nawf))
@@ -117,12 +301,12 @@ def build_HR_par_6(QE_xml_data_file,HR_file,Hk_file,Hk_space,
 
     del data
 
-    pool      = multiprocessing.Pool(processes = nproc)
+    HR_method = HR_method.lower()
+    if HR_method not in ['fft','gemm','direct']:
+       sys.exit('{0:s}: Value of HR_method not recognized'.format(fname))
 
-
-  
     if not WS_supercell_file:
-        w_Re,irvec_Re   = get_WS_supercell(nx,ny,nz,a_vectors)
+        w_Re,irvec_Re   = get_WS_supercell(nx,ny,nz,a_vectors,cache_dir=WS_cache_dir)
         cell_type       = 'wigner-seitz'
     else:
         print('This is WS_supercell_file: ', WS_supercell_file)
@@ -132,6 +316,11 @@ def build_HR_par_6(QE_xml_data_file,HR_file,Hk_file,Hk_space,
         w_Re      = 1.0/aux['ndegen_Re']
         cell_type = str(aux['cell_type'])
 
+    if HR_compact:
+        ihalf     = get_half_Rvectors_1(irvec_Re)
+        irvec_Re  = irvec_Re[ihalf]
+        w_Re      = w_Re[ihalf]
+
     nneighs   = len(irvec_Re)
 
     if is_wannier:
@@ -139,73 +328,281 @@ def build_HR_par_6(QE_xml_data_file,HR_file,Hk_file,Hk_space,
     else:
         nmatrices = 2
 
-    HR_mat = np.zeros((nspin,nneighs,nmatrices,nawf,nawf),dtype=np.complex_)
-
-    for ispin in range(nspin):
-        tic = time.time()
-        partial_build_HR= partial(build_HR_3,neigh_indx_3d=irvec_Re, \
-                                  nkpnts=nkpnts,kpnts=kpnts,kpnts_wght=kpnts_wght, \
-                                  alat=alat,a_vectors=a_vectors,nawf=nawf, \
-                                  ispin=ispin,Hk=Hk,Sk=Sk)
-
-        aux = pool.map(partial_build_HR,xrange(nneighs))
-  
-        pool.close()
-        pool.join()
-  
-
-        for ir in range(nneighs):
-            Haux,Saux = aux[ir]
-            HR_mat[ispin,ir,0,:,:] = Haux
-            if not is_wannier: 
-                HR_mat[ispin,ir,1,:,:] = Saux
-
-        toc = time.time()
-        hours, rem = divmod(toc-tic, 3600)
-        minutes, seconds = divmod(rem, 60)
-        print("{0:s}: Parallel processing of H[R] with {1:d} processors".format(fname,nproc))
-        print("{0:s}: Elapsed time {1:02d}:{2:02d}:{3:5.2f}".format(fname,int(hours),int(minutes),seconds))
+    if HR_method == 'fft':
+        kgrid_index = get_kgrid_index(kpnts,kpnts_wght,alat,a_vectors,nx,ny,nz)
+        if kgrid_index is None:
+            print('{0:s}: kpnts do not form a regular {1:d}x{2:d}x{3:d} grid.'
+                  ' Falling back to the direct sum'.format(fname,nx,ny,nz))
+            HR_method = 'gemm'
+
+    utils.set_profile_info_1(HR_method=HR_method,nproc=nproc,nR=nneighs,nkpnts=nkpnts,nawf=nawf,nspin=nspin)
+    if HR_method == 'fft':
+        print("{0:s}: FFT calculation of H[R] on a {1:d}x{2:d}x{3:d} grid".format(fname,nx,ny,nz))
+        with utils.profile_step('Fourier sum (fft)'):
+            HR_mat = build_HR_fft_1(irvec_Re,kgrid_index,nx,ny,nz,Hk,Sk)
+    elif HR_method == 'gemm' and nproc == 1:
+        print("{0:s}: Batched (GEMM) calculation of H[R] in blocks of {1:d} R-vectors".format(fname,HR_block_size))
+        with utils.profile_step('Fourier sum (gemm)'):
+            HR_mat = build_HR_gemm_1(irvec_Re,kpnts,kpnts_wght,alat,a_vectors,Hk,Sk,
+                                     block_size=HR_block_size)
+    else:
+        #Hk, Sk, kpnts and HR_mat are shared with the workers through
+        #memory-mapped files; each worker writes its block of R-vectors in place
+        print("{0:s}: Calculation of H[R] ({1:s}) with {2:d} worker processes".format(fname,HR_method,nproc))
+        nblock    = max(1,min(HR_block_size,-(-nneighs//nproc)))
+        ir_ranges = [(ir0,min(ir0+nblock,nneighs)) for ir0 in range(0,nneighs,nblock)]
+
+        shared_dir = utils.create_shared_dir_1(prefix='HR_')
+        try:
+            shared = {'Hk':     utils.create_shared_array_1(shared_dir,'Hk',Hk.shape,complex,Hk),
+                      'kpnts':  utils.create_shared_array_1(shared_dir,'kpnts',kpnts.shape,float,kpnts),
+                      'HR_mat': utils.create_shared_array_1(shared_dir,'HR_mat',
+                                                            (nspin,nneighs,nmatrices,nawf,nawf),complex)}
+            if not is_wannier:
+                shared['Sk'] = utils.create_shared_array_1(shared_dir,'Sk',Sk.shape,complex,Sk)
+
+            with utils.profile_step('Fourier sum ({0:s})'.format(HR_method)):
+                pool = multiprocessing.Pool(processes = nproc)
+                try:
+                    partial_build_HR = partial(build_HR_shm_block_1,shared=shared,irvec=irvec_Re,
+                                               kpnts_wght=kpnts_wght,alat=alat,a_vectors=a_vectors,
+                                               HR_method=HR_method,block_size=HR_block_size)
+                    utils.add_profile_workers_1(pool.map(partial_build_HR,ir_ranges))
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+
+            HR_mat = np.array(utils.attach_shared_array_1(shared['HR_mat'],mode='r'))
+        finally:
+            utils.remove_shared_dir_1(shared_dir)
+
+    if HR_compact and time_reversal:
+        imag_max = np.max(np.abs(HR_mat.imag))
+        if imag_max < real_tol:
+            HR_mat = np.ascontiguousarray(HR_mat.real)
+            print('{0:s}: Time-reversal symmetry, storing real H(R)'.format(fname))
+        else:
+            print('{0:s}: WARNING!!, max|Im H(R)| = {1:e} with time-reversal symmetry,'
+                  ' storing complex H(R)'.format(fname,imag_max))
 
-    np.savez(HR_file,HR_mat=HR_mat,irvec_Re=irvec_Re,cell_type=cell_type,Hk_space=Hk_space,\
-             w_Re=w_Re,alat=alat,a_vectors=a_vectors,nspin=nspin, nRe = len(w_Re), nibnds = nawf)
+    with utils.profile_step('write'):
+        utils.save_data_1(HR_file,HR_mat=HR_mat,irvec_Re=irvec_Re,cell_type=cell_type,Hk_space=Hk_space,\
+                 w_Re=w_Re,alat=alat,a_vectors=a_vectors,nspin=nspin, nRe = len(w_Re), nibnds = nawf,\
+                 HR_compact=HR_compact)
 
+    utils.save_stage_hash_1(fname,HR_file,stage_digest,stage_inputs,stage_params)
     print('{0:s}: Saving data in {1:s}'.format(fname,HR_file))
+    if HR_sparse_file:
+        save_HR_sparse_1(HR_file,QE_xml_data_file,HR_sparse_file,atom_norb,
+                         dist_cutoff=dist_cutoff,norm_cutoff=norm_cutoff,use_cache=use_cache)
     return HR_mat,irvec_Re,w_Re
-def get_WS_supercell(nk1,nk2,nk3,a_vectors):
-    startt = time.time()
-    nrpts = 0
-    eps7  = 1e-7
+def get_half_Rvectors_1(irvec):
+    """
+    Indices of R=0 and of the R-vectors with a positive first non-zero
+    component, i.e. one R of every (R,-R) pair of irvec.
+    Exits if some -R is missing from irvec.
+    """
+    fname = utils.fname()
+    irvec = np.asarray(irvec,dtype=int)
+    nmax  = 2*np.max(np.abs(irvec))+1
+    key   = (irvec[:,0]*nmax+irvec[:,1])*nmax+irvec[:,2]
+    if not np.array_equal(np.sort(key),np.sort(-key)):
+        sys.exit('{0:s}: the R-vectors are not closed under R -> -R'.format(fname))
+    return np.where(key >= 0)[0]
+HR_decay_dtype = [('ir',int),('iat',int),('jat',int),('dist',float),('normH',float),('normS',float),('kept',bool)]
+
+def build_HR_sparse_1(HR_mat,irvec,a_vectors,atoms_coords,atom_norb,dist_cutoff=0.0,norm_cutoff=0.0):
+    """
+    Atom-pair block-sparse form of HR_mat[nspin,nR,nmatrices,nawf,nawf].
+    Block (ir,iat,jat) holds <iat,0|H|jat,R> (and S), with the atoms at
+    distance |R + tau_jat - tau_iat|. A block is kept if its distance is
+    <= dist_cutoff and its Frobenius norm (largest over spins, H and S) is
+    >= norm_cutoff; a cutoff <= 0 is not applied.
+    atoms_coords[natoms,3] in Bohrs, atom_norb[natoms]: orbitals per atom, in
+    the order of the atomic wavefunctions of atomic_proj.xml.
+    returns sparse: dictionary with the kept blocks blk_ir, blk_iat, blk_jat,
+                    their offsets blk_ptr[nblk+1] in HR_data[nspin,nmatrices,ndata]
+                    (each block flattened in C order), orb_ptr[natoms+1]
+            report: structured array (HR_decay_dtype), one entry per block
+    """
+    fname = utils.fname()
+    nspin,nR,nmatrices,nawf,_ = HR_mat.shape
+    atom_norb    = np.asarray(atom_norb,dtype=int)
+    atoms_coords = np.asarray(atoms_coords,dtype=float)
+    natoms       = len(atom_norb)
+    if np.sum(atom_norb) != nawf or np.any(atom_norb < 1):
+        sys.exit('{0:s}: atom_norb does not add up to nawf = {1:d}'.format(fname,nawf))
+    if atoms_coords.shape != (natoms,3):
+        sys.exit('{0:s}: atoms_coords and atom_norb have different number of atoms'.format(fname))
+    orb_ptr = np.concatenate(([0],np.cumsum(atom_norb)))
+
+    Rarray = np.dot(irvec,a_vectors) #in Bohrs
+    dist   = la.norm(Rarray[:,None,None,:]+atoms_coords[None,None,:,:]-atoms_coords[None,:,None,:],axis=3)
+
+    #block norms[nspin,nR,nmatrices,natoms,natoms]
+    norms = np.add.reduceat(np.add.reduceat(np.abs(HR_mat)**2,orb_ptr[:-1],axis=3),orb_ptr[:-1],axis=4)
+    norms = np.sqrt(np.max(norms,axis=0))
+
+    keep = np.ones((nR,natoms,natoms),dtype=bool)
+    if dist_cutoff > 0:
+        keep &= dist <= dist_cutoff
+    if norm_cutoff > 0:
+        keep &= np.max(norms,axis=1) >= norm_cutoff
+
+    report = np.zeros(nR*natoms*natoms,dtype=HR_decay_dtype)
+    report['ir'],report['iat'],report['jat'] = [aux.ravel() for aux in np.indices((nR,natoms,natoms))]
+    report['dist']  = dist.ravel()
+    report['normH'] = norms[:,0,:,:].ravel()
+    if nmatrices > 1:
+        report['normS'] = norms[:,1,:,:].ravel()
+    report['kept']  = keep.ravel()
+
+    blk_ir,blk_iat,blk_jat = np.nonzero(keep)
+    blk_ptr = np.concatenate(([0],np.cumsum(atom_norb[blk_iat]*atom_norb[blk_jat])))
+    sparse  = {'blk_ir':blk_ir,'blk_iat':blk_iat,'blk_jat':blk_jat,'blk_ptr':blk_ptr,
+               'orb_ptr':orb_ptr,'nspin':nspin,'nawf':nawf,'nmatrices':nmatrices}
+    ir,row,col = get_HR_sparse_index_1(sparse)
+    sparse['HR_data'] = np.transpose(HR_mat[:,ir,:,row,col],(1,2,0))
+    return sparse,report
+def get_HR_sparse_index_1(sparse):
+    """
+    R-vector, row and column of every element of sparse['HR_data']
+    (see build_HR_sparse_1)
+    """
+    blk_ptr = sparse['blk_ptr']
+    orb_ptr = sparse['orb_ptr']
+    iblk    = np.repeat(np.arange(len(blk_ptr)-1),np.diff(blk_ptr))
+    local   = np.arange(blk_ptr[-1]) - blk_ptr[iblk]
+    norb_j  = np.diff(orb_ptr)[sparse['blk_jat'][iblk]]
+    row     = orb_ptr[sparse['blk_iat'][iblk]] + local//norb_j
+    col     = orb_ptr[sparse['blk_jat'][iblk]] + local%norb_j
+    return sparse['blk_ir'][iblk],row,col
+def get_HR_csr_1(sparse,ispin,imatrix,nR):
+    """
+    H(R) (imatrix=0) or S(R) (imatrix=1) of a block-sparse H(R) as a
+    scipy.sparse matrix [nR x nawf*nawf], the input of get_Hk_from_HR_1
+    """
+    nawf = int(sparse['nawf'])
+    ir,row,col = get_HR_sparse_index_1(sparse)
+    return sps.csr_matrix((sparse['HR_data'][ispin,imatrix,:],(ir,row*nawf+col)),shape=(nR,nawf*nawf))
+def save_HR_sparse_1(HR_file,QE_xml_data_file,HR_sparse_file,atom_norb,dist_cutoff=0.0,norm_cutoff=0.0,
+                     use_cache=True):
+    """
+    Saves the block-sparse H(R) (build_HR_sparse_1) of HR_file in
+    HR_sparse_file, which get_interpolated_bands_3 reads like HR_file.
+    The decay report, one line per atom-pair block sorted by distance, is
+    written to <HR_sparse_file without extension>_decay.dat
+    returns sparse, report
+    """
+    fname = utils.fname()
+    if atom_norb is None:
+        sys.exit('{0:s}: atom_norb is needed for the block-sparse H(R)'.format(fname))
+    decay_file   = os.path.splitext(HR_sparse_file.rstrip('/'))[0]+'_decay.dat'
+    stage_inputs = [HR_file,QE_xml_data_file]
+    stage_params = {'atom_norb':[int(aux) for aux in atom_norb],'dist_cutoff':float(dist_cutoff),
+                    'norm_cutoff':float(norm_cutoff)}
+    stage_digest = utils.stage_hash_1(fname,stage_inputs,stage_params)
+    if utils.check_stage_cache_1(fname,HR_sparse_file,stage_digest,use_cache=use_cache) and \
+       os.path.isfile(decay_file):
+        aux = utils.load_data_1(HR_sparse_file)
+        return dict([(key,aux[key]) for key in HR_sparse_keys]),np.loadtxt(decay_file,dtype=HR_decay_dtype)
+
+    data = utils.load_data_1(QE_xml_data_file)
+    if 'atoms_coords' not in data:
+        sys.exit('{0:s}: no atomic positions in {1:s}; rerun read_QE_output_xml_v4 '
+                 'with use_cache=False'.format(fname,QE_xml_data_file))
+    atoms_coords = data['atoms_coords']
+    aux = utils.load_data_1(HR_file)
+    sparse,report = build_HR_sparse_1(aux['HR_mat'],aux['irvec_Re'],aux['a_vectors'],atoms_coords,
+                                      atom_norb,dist_cutoff=dist_cutoff,norm_cutoff=norm_cutoff)
+    for key in ['irvec_Re','w_Re','cell_type','Hk_space','alat','a_vectors']:
+        sparse[key] = aux[key]
+    if 'HR_compact' in aux:
+        sparse['HR_compact'] = bool(aux['HR_compact'])
+    else:
+        sparse['HR_compact'] = False
+    sparse['HR_format'] = 'block_sparse'
+    report = report[np.argsort(report['dist'],kind='mergesort')]
+    np.savetxt(decay_file,report,fmt='%6d %5d %5d %14.8f %14.6e %14.6e %2d',
+               header='ir iat jat |R+tau_j-tau_i|(Bohr) |H|_F |S|_F kept')
+    utils.save_data_1(HR_sparse_file,dist_cutoff=dist_cutoff,norm_cutoff=norm_cutoff,**sparse)
+    utils.save_stage_hash_1(fname,HR_sparse_file,stage_digest,stage_inputs,stage_params)
+
+    nR,nawf  = len(sparse['w_Re']),int(sparse['nawf'])
+    ndropped = np.sum(~report['kept'])
+    print('{0:s}: Kept {1:d} of {2:d} atom-pair blocks ({3:5.2f}% of the dense H(R))'.format(fname,
+          len(sparse['blk_ir']),len(report),100.0*sparse['blk_ptr'][-1]/(nR*nawf*nawf)))
+    if ndropped > 0:
+        print('{0:s}: Largest dropped block norm |H|_F = {1:e}'.format(fname,np.max(report['normH'][~report['kept']])))
+    print('{0:s}: Saving data in {1:s}, decay report in {2:s}'.format(fname,HR_sparse_file,decay_file))
+    return sparse,report
+HR_sparse_keys = ['blk_ir','blk_iat','blk_jat','blk_ptr','orb_ptr','nspin','nawf','nmatrices','HR_data',
+                  'irvec_Re','w_Re','cell_type','Hk_space','alat','a_vectors','HR_format','HR_compact']
+
+@utils.profile_stage('get_WS_supercell')
+def get_WS_supercell(nk1,nk2,nk3,a_vectors,cache_dir=''):
+    """
+    Wigner-Seitz supercell of the nk1 x nk2 x nk3 real-space grid.
+    For every lattice vector n in [-2nk,2nk]^3 the squared distances to its
+    125 images n - i*nk, i in [-2,2]^3, are computed at once with the metric
+    tensor a.a^T, one n1-slab at a time to keep memory bounded. n belongs to
+    the cell if the image i=0 is (one of) the closest, with ndegen equal to
+    the number of closest images.
+    cache_dir: if given, (irvec,ndegen) are stored in / reused from
+               cache_dir/WS_supercell_<key>.npz, where <key> is a hash of
+               (nk1,nk2,nk3,a_vectors).
+    returns w_Re=1/ndegen, irvec
+    """
+    fname  = utils.fname()
+    eps7   = 1e-7
+
+    if cache_dir:
+        key = '{0:d} {1:d} {2:d} '.format(nk1,nk2,nk3) + \
+              ' '.join(['{0:.10e}'.format(x) for x in np.ravel(a_vectors)])
+        cache_file = os.path.join(cache_dir,'WS_supercell_{0:s}.npz'.format(
+                                  hashlib.sha1(key.encode('ascii')).hexdigest()))
+        if os.path.isfile(cache_file):
+            aux = np.load(cache_file)
+            if str(aux['key']) == key:
+                print("{0:s}: Using cached W-S supercell {1:s}".format(fname,cache_file))
+                return 1/aux['ndegen'],aux['irvec']
+
+    nk    = np.array([nk1,nk2,nk3])
+    metric= np.dot(a_vectors,np.transpose(a_vectors))
+
+    aux   = np.arange(-2,2+1)
+    imgs  = np.array(np.meshgrid(aux,aux,aux,indexing='ij')).reshape((3,125)).T*nk #125 x 3
+    n2,n3 = np.meshgrid(np.arange(-2*nk2,2*nk2+1),np.arange(-2*nk3,2*nk3+1),indexing='ij')
+    n2    = n2.ravel()
+    n3    = n3.ravel()
+
     ndegen= []
     irvec = []
-    dist = np.zeros(125)
     for n1 in range(-2*nk1,2*nk1+1):
-        for n2 in range(-2*nk2,2*nk2+1): 
-            for n3 in range(-2*nk3,2*nk3+1):
-                icnt = 0
-                for i1 in range(-2,2+1): 
-                    for i2 in range(-2,2+1): 
-                        for i3 in range(-2,2+1):
-                            ndiff     = [n1-i1*nk1,n2-i2*nk2,n3-i3*nk3]
-                            dist[icnt]= la.norm(np.dot(ndiff,a_vectors))**2
-                            icnt      = icnt + 1
-                dist_min = np.min(dist)               
-                if  np.abs(dist[62]-dist_min ) < eps7:
-                    nrpts = nrpts + 1
-                    ndegen = ndegen + [len((np.where(np.abs(dist-dist_min)<eps7))[0])]
-                    irvec  = irvec + [[n1,n2,n3]]
-    if len(irvec) != nrpts: 
-        print(len(irvec),nrpts)
-        sys.exit('wrong dimensions')
-    
-    tot = np.sum( 1/np.array(ndegen))
+        nvec  = np.column_stack((np.full(n2.shape,n1),n2,n3))      #nslab x 3
+        ndiff = nvec[:,None,:]-imgs[None,:,:]                      #nslab x 125 x 3
+        dist  = np.einsum('nia,ab,nib->ni',ndiff,metric,ndiff)
+        dist_min = np.min(dist,axis=1)
+        inside= np.abs(dist[:,62]-dist_min) < eps7
+        ndegen.append(np.sum(np.abs(dist[inside,:]-dist_min[inside,None]) < eps7,axis=1))
+        irvec.append(nvec[inside,:])
+    ndegen = np.concatenate(ndegen)
+    irvec  = np.concatenate(irvec)
+
+    tot = np.sum( 1/ndegen.astype(float))
     if (np.abs(tot - nk1*nk2*nk3) > eps7) : 
        print(tot)
        sys.exit('Missing some points in W-S cell')
 
-    endt = time.time()
-    elapsed1 = str(datetime.timedelta(seconds=(endt - startt)))
-    print("get_WS_supercell: elapsed time  {0:s}".format(elapsed1))
-    return 1/np.array(ndegen),np.array(irvec)
+    if cache_dir:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        np.savez(cache_file,irvec=irvec,ndegen=ndegen,key=key)
+        print("{0:s}: W-S supercell saved to {1:s}".format(fname,cache_file))
+    return 1/ndegen.astype(float),irvec
 def linspace_vector_2(v1,v2,ndivs):
     lx = np.reshape(np.linspace(v1[0],v2[0],ndivs),(ndivs,1))
     ly = np.reshape(np.linspace(v1[1],v2[1],ndivs),(ndivs,1))
@@ -226,133 +623,579 @@ def create_kpaths_2(nkmesh,K):
             lvec = lvec[:-1,:]
         list_aux = list_aux + lvec.tolist()
     return list_aux
-def get_interpolated_bands_3(Kfrac,nkmesh,HR_mat_path,fig_erange=[-20,10]):
+def get_Hk_from_HR_1(Karray,Rarray,w_Re,HR,compact=False,deriv=False):
     """
-    get_interpolated_bands_3, changes the variable neigh_indx_3d for irvec
-    get_interpolated_bands_2: Does not use nx,ny,nz. Loads the real-space grid from HR_mat
+    Batched Fourier interpolation for a chunk of k-points:
+        H(k) = sum_R w_Re*exp(+i K.R)*H(R)
+    The phase matrix [nk x nR] is built once and contracted with H(R).
+    Karray[nk,3] in 1/Bohrs, Rarray[nR,3] in Bohrs, HR[nR,nawf,nawf] or a
+    scipy.sparse HR[nR,nawf*nawf] (see get_HR_csr_1), real or complex
+    compact: HR holds only R=0 and one R of every (R,-R) pair
+             (get_half_Rvectors_1); the sum is completed with H(-R)=H(R)^H as
+             H(k) = B + B^H, B = the sum over the stored R with w_Re(0)/2
+    deriv: also returns dHk[3,nk,nawf,nawf] = dH/dk_alpha (eV*Bohr),
+               dH/dk_alpha = sum_R i R_alpha w_Re exp(+i K.R) H(R)
+           from the same contraction, with the phases of H(k) and of the
+           three derivatives stacked in one [4*nk x nR] matrix
+    returns Hk[nk,nawf,nawf] (and dHk if deriv)
     """
-    aux=np.load(HR_mat_path)
-    HR_mat        = aux['HR_mat']
-    irvec         = aux['irvec_Re']
-    cell_type     = str(aux['cell_type'])
-    Hk_space      = str(aux['Hk_space'])
-    w_Re          = aux['w_Re']
-    a_vectors     = aux['a_vectors']
-    alat          = aux['alat']
-    nspin         = aux['nspin']
-    
-    nawf          = HR_mat.shape[3]
-
-
-
-    B          = 2*np.pi*la.inv(np.transpose(a_vectors))
-    Kfrac_list = np.dot(np.array(Kfrac),B).tolist()
-    Kpath,_    = utils.create_kpaths(nkmesh,Kfrac_list)
-    nkpath     = len(Kpath)
-    nneighs    = len(irvec)
-    Rarray     = np.dot(irvec,a_vectors) #a_vectors are in Bohrs
-    Ek         = np.zeros((nawf,nkpath,nspin))
-
-    nmatrices  = HR_mat.shape[2]
-    Hk_space = Hk_space.lower()
+    nk = len(Karray)
+    if compact:
+        w_Re = np.array(w_Re,dtype=float)
+        w_Re[np.all(np.abs(Rarray) < 1e-12,axis=1)] *= 0.5
+    phase = w_Re[None,:]*np.exp(1j*np.dot(Karray,np.transpose(Rarray)))
+    if deriv:
+        phase = np.concatenate([phase]+[1j*Rarray[None,:,alpha]*phase for alpha in range(3)])
+    if sps.issparse(HR):
+        nawf = int(round(np.sqrt(HR.shape[1])))
+        Hk   = np.transpose(HR.T.dot(phase.T)).reshape((len(phase),nawf,nawf))
+    else:
+        Hk   = np.tensordot(phase,HR,axes=(1,0))
+    if compact:
+        Hk = Hk + np.conj(np.swapaxes(Hk,1,2))
+    if deriv:
+        return Hk[:nk],Hk[nk:].reshape((3,)+Hk[:nk].shape)
+    return Hk
+Sk_report_dtype = [('ispin',int),('ik',int),('positive',bool),('min_eig',float),('cond',float)]
+
+def hermitize_1(A):
+    """
+    Hermitian matrices built from the upper triangle of A[...,n,n]:
+    triu(A,1)+diag(A)+triu(A,1)^H, on stacks of matrices
+    """
+    Au = np.triu(A,1)
+    return Au + np.conj(np.swapaxes(Au,-1,-2)) + A*np.eye(A.shape[-1])
+def eigh_gen_chol_1(Hk,Sk,eigvec=False,cond_max=1e8):
+    """
+    Batched Hermitian-definite generalized eigenproblem H(k)c = E S(k)c for a
+    stack of k-points. One Cholesky factorization S = L L^H per k-point is
+    both the positive-definiteness check and the reduction to the standard
+    problem (L^-1 H L^-H) y = E y, c = L^-H y.
+    k-points where S(k) is not positive definite are solved with the general
+    eigensolver (real part of the eigenvalues), as before.
+    Hk,Sk[nk,nawf,nawf]: only the upper triangles are used.
+    cond_max: S(k) with an estimated condition number above cond_max are
+              reported as ill-conditioned.
+    returns eigval[nk,nawf] (ascending), eigvec[nk,nawf,nawf] (or None),
+            report: structured array (Sk_report_dtype) with one entry per
+            ill-conditioned or non positive definite S(k)
+    """
+    Hk   = hermitize_1(Hk)
+    Sk   = hermitize_1(Sk)
+    nk   = Hk.shape[0]
+    nawf = Hk.shape[1]
+
+    L    = np.zeros_like(Sk)
+    positive = np.ones(nk,dtype=bool)
+    try:
+        L[...] = la.cholesky(Sk)
+    except la.LinAlgError:
+        for ik in range(nk):
+            try:
+                L[ik] = la.cholesky(Sk[ik])
+            except la.LinAlgError:
+                positive[ik] = False
+                L[ik] = np.eye(nawf)
+
+    Ldiag    = np.abs(np.diagonal(L,axis1=1,axis2=2))
+    cond_est = (np.max(Ldiag,axis=1)/np.min(Ldiag,axis=1))**2
+    ireport  = np.where(np.logical_or(~positive,cond_est > cond_max))[0]
+    report   = np.zeros(len(ireport),dtype=Sk_report_dtype)
+    for i,ik in enumerate(ireport):
+        eigS = la.eigvalsh(Sk[ik])
+        report[i] = (0,ik,positive[ik],eigS[0],np.max(np.abs(eigS))/np.min(np.abs(eigS)))
+
+    Linv  = la.inv(L)
+    LinvH = np.conj(np.swapaxes(Linv,1,2))
+    Ht    = np.matmul(np.matmul(Linv,Hk),LinvH)
+    if eigvec:
+        eigval,vec = la.eigh(Ht,UPLO='U')
+        vec = np.matmul(LinvH,vec)
+    else:
+        eigval = la.eigvalsh(Ht,UPLO='U')
+        vec    = None
+
+    for ik in np.where(~positive)[0]:
+        aux,auxvec = sla.eig(Hk[ik],Sk[ik])
+        isort      = np.argsort(np.real(aux))
+        eigval[ik] = np.real(aux)[isort]
+        if eigvec:
+            vec[ik] = auxvec[:,isort]
+
+    return eigval,vec,report
+def load_HR_model_1(HR_mat_path):
+    """
+    Loads a dense H(R) (build_HR_par_6) or block-sparse H(R) (save_HR_sparse_1)
+    returns dictionary with HR_mat (array or block-sparse dictionary),
+            Rarray[nR,3] (Bohrs), w_Re, a_vectors, alat, nspin, nawf,
+            cell_type, Hk_space, nonortho_space, HR_compact
+    """
+    fname = utils.fname()
+    aux   = utils.load_data_1(HR_mat_path)
+    if 'HR_format' in aux and str(aux['HR_format']) == 'block_sparse':
+        HR_mat = dict([(key,aux[key]) for key in HR_sparse_keys])
+        nawf   = int(aux['nawf'])
+    else:
+        HR_mat = aux['HR_mat']
+        nawf   = HR_mat.shape[3]
+    if 'HR_compact' in aux:
+        HR_compact = bool(aux['HR_compact'])
+    else:
+        HR_compact = False
 
+    Hk_space = str(aux['Hk_space']).lower()
     if (Hk_space == 'ortho') or (Hk_space == 'wannier'):
-        nonortho_space= False
+        nonortho_space = False
     elif Hk_space == 'nonortho':
-        nonortho_space= True
+        nonortho_space = True
     else:
-        sys.exit('get_interpolated_bands_3: wrong Hk_space')
-
-         
-
-    for ik in range(nkpath):
-        for ispin in range(nspin):
-            Hk = np.zeros((nawf,nawf),dtype=complex)
-            if nonortho_space: Sk = np.zeros((nawf,nawf),dtype=complex)
-            for ineigh in range(nneighs):
-                H = HR_mat[ispin,ineigh,0,:,:]
-                if nonortho_space:
-                    S = HR_mat[ispin,ineigh,1,:,:]
-                K   = Kpath[ik]      #K in 1/Bohrs
-                R   = Rarray[ineigh,:]
-                
-                
-                Hk  = Hk + w_Re[ineigh]*H*np.exp(+1j*np.dot(K,R))
-                if nonortho_space: Sk  = Sk + w_Re[ineigh]*S*np.exp(+1j*np.dot(K,R))
-
-            Hk_hermitian = np.triu(Hk,1)+np.diag(np.diag(Hk))+np.conj(np.triu(Hk,1)).T
-
-            if nonortho_space:
-                Sk_hermitian = np.triu(Sk,1)+np.diag(np.diag(Sk))+np.conj(np.triu(Sk,1)).T
-            
-                is_positive = np.all(la.eigvalsh(Sk_hermitian) > 0)
-                if not is_positive:
-                    print("Sk_hermitian not positive definite at ik = {0:2d}".format(ik))
-
-            if nonortho_space:
-                eigval, _ = sla.eig(Hk_hermitian,Sk_hermitian)
+        sys.exit('{0:s}: wrong Hk_space'.format(fname))
+
+    a_vectors = aux['a_vectors']
+    return {'HR_mat':HR_mat,'Rarray':np.dot(aux['irvec_Re'],a_vectors),'w_Re':aux['w_Re'],
+            'a_vectors':a_vectors,'alat':float(aux['alat']),'nspin':int(aux['nspin']),'nawf':nawf,
+            'cell_type':str(aux['cell_type']),'Hk_space':Hk_space,'nonortho_space':nonortho_space,
+            'HR_compact':HR_compact}
+class TBModel(object):
+    """
+    Tight-binding model kept in memory: H(R) (and S(R)) of HR_mat_path
+    (dense, block-sparse or compact, see load_HR_model_1), the R-vectors and
+    the lattice. hk, sk and eig work on arrays of k-points without file
+    I/O or plotting.
+    kpts[nk,3] are in crystal coordinates (units='crystal') or cartesian
+    in 1/Bohrs (units='cartesian').
+    """
+    def __init__(self,HR_mat_path):
+        model = load_HR_model_1(HR_mat_path)
+        for key in model:
+            setattr(self,key,model[key])
+        self.HR_mat_path = HR_mat_path
+        self.b_vectors   = 2*np.pi*la.inv(np.transpose(self.a_vectors)) #1/Bohrs
+        nmatrices = 2 if self.nonortho_space else 1
+        #per spin and matrix (H,S): dense [nR,nawf,nawf] or scipy.sparse [nR,nawf*nawf]
+        self.HR_list = []
+        for ispin in range(self.nspin):
+            if isinstance(self.HR_mat,dict):
+                self.HR_list.append([get_HR_csr_1(self.HR_mat,ispin,imatrix,len(self.w_Re))
+                                     for imatrix in range(nmatrices)])
             else:
-                eigval = sla.eigvalsh(Hk_hermitian)
-
-            Ek[:,ik,ispin] = np.sort(np.real(eigval))
+                self.HR_list.append([np.ascontiguousarray(self.HR_mat[ispin,:,imatrix,:,:])
+                                     for imatrix in range(nmatrices)])
+    def get_Karray(self,kpts,units='crystal'):
+        """
+        k-points in 1/Bohrs
+        """
+        kpts = np.atleast_2d(np.asarray(kpts,dtype=float))
+        if units == 'crystal':
+            return np.dot(kpts,self.b_vectors)
+        elif units == 'cartesian':
+            return kpts
+        sys.exit('TBModel: units {0:s} not recognized'.format(units))
+    def hk(self,kpts,ispin=0,units='crystal',deriv=False):
+        """
+        returns H(k)[nk,nawf,nawf] (and dH/dk[3,nk,nawf,nawf] if deriv,
+        see get_Hk_from_HR_1)
+        """
+        return get_Hk_from_HR_1(self.get_Karray(kpts,units),self.Rarray,self.w_Re,self.HR_list[ispin][0],
+                                compact=self.HR_compact,deriv=deriv)
+    def sk(self,kpts,ispin=0,units='crystal',deriv=False):
+        """
+        returns S(k)[nk,nawf,nawf] (and dS/dk if deriv); the identity (and
+        zero) in an orthogonal basis
+        """
+        Karray = self.get_Karray(kpts,units)
+        if not self.nonortho_space:
+            Sk = np.tile(np.eye(self.nawf,dtype=complex),(len(Karray),1,1))
+            if deriv:
+                return Sk,np.zeros((3,)+Sk.shape,dtype=complex)
+            return Sk
+        return get_Hk_from_HR_1(Karray,self.Rarray,self.w_Re,self.HR_list[ispin][1],
+                                compact=self.HR_compact,deriv=deriv)
+    def eig(self,kpts,units='crystal',eigvec=False,velocity=False,deg_tol=1e-4,k_block_size=1000):
+        """
+        Eigenvalues of H(k) (generalized with S(k) in a non-orthogonal
+        basis, see eigh_gen_chol_1), in chunks of k_block_size k-points.
+        velocity: dH/dk and dS/dk are computed in the same pass as H(k) and
+                  S(k), and the band velocities with get_band_velocities_1
+        returns Ek[nk,nspin,nawf] (eV), vec[nk,nspin,nawf,nawf] (or None),
+                vk[nk,nspin,nawf,3] in eV*Bohr (or None),
+                Sk_report: structured array (Sk_report_dtype)
+        """
+        Karray = self.get_Karray(kpts,units)
+        nk     = len(Karray)
+        nawf   = self.nawf
+        Ek     = np.zeros((nk,self.nspin,nawf))
+        vec    = np.zeros((nk,self.nspin,nawf,nawf),dtype=complex) if eigvec else None
+        vk     = np.zeros((nk,self.nspin,nawf,3)) if velocity else None
+        Sk_report = [np.zeros(0,dtype=Sk_report_dtype)]
+        if k_block_size <= 0:
+            k_block_size = nk
+
+        for ispin in range(self.nspin):
+            for ik0 in range(0,nk,k_block_size):
+                ik1 = min(ik0+k_block_size,nk)
+                eigval,auxvec,dHk,dSk,_,report = self.eig_block(Karray[ik0:ik1],ispin,eigvec=(eigvec or velocity),
+                                                                velocity=velocity)
+                report['ik'] += ik0
+                Sk_report.append(report)
+                Ek[ik0:ik1,ispin,:] = eigval
+                if eigvec:
+                    vec[ik0:ik1,ispin,:,:] = auxvec
+                if velocity:
+                    with utils.profile_step('velocities'):
+                        vk[ik0:ik1,ispin,:,:] = get_band_velocities_1(eigval,auxvec,dHk,dSk,deg_tol=deg_tol)
+
+        return Ek,vec,vk,np.concatenate(Sk_report)
+    def eig_block(self,Karray,ispin,eigvec=False,velocity=False):
+        """
+        Diagonalization of one block of k-points Karray[nk,3] (1/Bohrs)
+        returns eigval[nk,nawf], vec[nk,nawf,nawf] (or None), dHk and dSk
+                (None unless velocity), Sk (None in an orthogonal basis),
+                Sk_report
+        """
+        with utils.profile_step('Fourier sum'):
+            aux = self.hk(Karray,ispin,units='cartesian',deriv=velocity)
+            Hk,dHk = aux if velocity else (aux,None)
+            Sk,dSk = None,None
+            if self.nonortho_space:
+                aux = self.sk(Karray,ispin,units='cartesian',deriv=velocity)
+                Sk,dSk = aux if velocity else (aux,None)
+        report = np.zeros(0,dtype=Sk_report_dtype)
+        with utils.profile_step('diagonalize'):
+            if self.nonortho_space:
+                eigval,vec,report = eigh_gen_chol_1(Hk,Sk,eigvec=eigvec)
+                report['ispin'] = ispin
+            elif eigvec:
+                eigval,vec = la.eigh(Hk,UPLO='U')
+            else:
+                eigval = la.eigvalsh(Hk,UPLO='U')
+                vec    = None
+        return eigval,vec,dHk,dSk,Sk,report
+    def eig_proj(self,kpts,groups,units='crystal',method='mulliken',k_block_size=1000):
+        """
+        Eigenvalues and orbital-group weights (get_projection_weights_1) in
+        one batched pass: the eigenvectors of a block of k-points are reduced
+        to the weights of the groups and dropped.
+        groups: group index of every orbital (get_orbital_groups_1)
+        returns Ek[nk,nspin,nawf], weights[nk,nspin,nawf,ngroups],
+                Sk_report: structured array (Sk_report_dtype)
+        """
+        if method not in ['mulliken','lowdin']:
+            sys.exit('TBModel: projection method {0:s} not recognized'.format(method))
+        groups  = np.asarray(groups)
+        ngroups = np.max(groups)+1
+        Karray  = self.get_Karray(kpts,units)
+        nk      = len(Karray)
+        Ek      = np.zeros((nk,self.nspin,self.nawf))
+        weights = np.zeros((nk,self.nspin,self.nawf,ngroups))
+        Sk_report = [np.zeros(0,dtype=Sk_report_dtype)]
+        if k_block_size <= 0:
+            k_block_size = nk
+
+        for ispin in range(self.nspin):
+            for ik0 in range(0,nk,k_block_size):
+                ik1 = min(ik0+k_block_size,nk)
+                eigval,vec,_,_,Sk,report = self.eig_block(Karray[ik0:ik1],ispin,eigvec=True)
+                report['ik'] += ik0
+                Sk_report.append(report)
+                Ek[ik0:ik1,ispin,:] = eigval
+                with utils.profile_step('projections'):
+                    weights[ik0:ik1,ispin,:,:] = get_projection_weights_1(vec,Sk,groups,ngroups,method)
+
+        return Ek,weights,np.concatenate(Sk_report)
+def get_orbital_groups_1(orbitals_l,by='atom_l'):
+    """
+    Orbital groups for projected bands and DOS, from the angular momenta of
+    the atomic wavefunctions of every atom (get_atoms_orbitals_l_1); the
+    2l+1 orbitals of a wavefunction are consecutive, as in projwfc.
+    by: 'atom_l' = one group per atom and l, 'atom' = per atom, 'l' = per l
+    returns groups[nawf] (group index of every orbital), labels[ngroups]
+    """
+    fname   = utils.fname()
+    lname   = 'spdfgh'
+    keys    = []
+    groups  = []
+    for iatom,atom_l in enumerate(orbitals_l):
+        for l in atom_l:
+            if by == 'atom_l':
+                key = 'atom{0:d}_{1:s}'.format(iatom+1,lname[l])
+            elif by == 'atom':
+                key = 'atom{0:d}'.format(iatom+1)
+            elif by == 'l':
+                key = lname[l]
+            else:
+                sys.exit('{0:s}: Value of by not recognized'.format(fname))
+            if key not in keys:
+                keys.append(key)
+            groups += [keys.index(key)]*(2*l+1)
+    if by == 'l':
+        isort  = sorted(range(len(keys)),key=lambda i: lname.index(keys[i]))
+        groups = [isort.index(i) for i in groups]
+        keys   = [keys[i] for i in isort]
+    return np.array(groups),keys
+def get_projection_weights_1(vec,Sk,groups,ngroups,method='mulliken'):
+    """
+    Weights of the orbital groups in the eigenvectors vec[nk,nawf,nbnd]
+    (S-orthonormal columns), summed over the orbitals mu of every group:
+        mulliken: w_mu,n = Re(conj(c_mu,n) (S c)_mu,n)
+        lowdin:   w_mu,n = |(S^1/2 c)_mu,n|^2
+    Both add up to 1 for every band; Loewdin weights are never negative.
+    Sk[nk,nawf,nawf]: only the upper triangle is used; None in an
+                      orthogonal basis (w = |c|^2)
+    returns weights[nk,nbnd,ngroups]
+    """
+    nawf = vec.shape[1]
+    if Sk is None:
+        w = np.abs(vec)**2
+    elif method == 'mulliken':
+        w = np.real(np.conj(vec)*np.matmul(hermitize_1(Sk),vec))
+    else:
+        eigS,U = la.eigh(Sk,UPLO='U')
+        Shalf  = np.matmul(U*np.sqrt(np.maximum(eigS,0))[:,None,:],np.conj(np.swapaxes(U,1,2)))
+        w = np.abs(np.matmul(Shalf,vec))**2
+
+    G = np.zeros((ngroups,nawf))
+    G[groups,np.arange(nawf)] = 1.0
+    return np.swapaxes(np.matmul(G,w),1,2)
+@utils.profile_stage('get_interpolated_bands_3')
+def get_interpolated_bands_3(Kfrac,nkmesh,HR_mat_path,fig_erange=[-20,10],k_block_size=100,orbitals_l=None,
+                             proj_by='atom_l',proj_method='mulliken',bands_text=False):
+    """
+    get_interpolated_bands_3, changes the variable neigh_indx_3d for irvec
+    get_interpolated_bands_2: Does not use nx,ny,nz. Loads the real-space grid from HR_mat
+    k_block_size: number of k-points interpolated and diagonalized per batch
+                  (see TBModel.eig)
+    HR_mat_path: dense H(R) (build_HR_par_6) or block-sparse H(R) (save_HR_sparse_1)
+    orbitals_l: angular momenta of the orbitals of every atom
+                (get_atoms_orbitals_l_1); if given, the weights of the
+                orbital groups proj_by (get_orbital_groups_1) are computed
+                with proj_method ('mulliken' or 'lowdin') in the same pass
+                and saved with the bands in bands_proj.npz
+    bands_text: also writes the bands as gnuplot text files (band_plot_3)
+    returns Sk_report: k-points with ill-conditioned or non positive definite S(k)
+    """
+    model      = TBModel(HR_mat_path)
+    Kfrac_list = np.dot(np.array(Kfrac),model.b_vectors).tolist()
+    Kpath,_    = utils.create_kpaths(nkmesh,Kfrac_list)
 
-    Kpath1 = np.array(Kpath)/(2*np.pi/alat)
+    if orbitals_l is None:
+        Ek,_,_,Sk_report = model.eig(Kpath,units='cartesian',k_block_size=k_block_size)
+    else:
+        groups,labels = get_orbital_groups_1(orbitals_l,proj_by)
+        if len(groups) != model.nawf:
+            sys.exit('get_interpolated_bands_3: orbitals_l gives {0:d} orbitals, H(R) has {1:d}'.format(
+                     len(groups),model.nawf))
+        Ek,weights,Sk_report = model.eig_proj(Kpath,groups,units='cartesian',method=proj_method,
+                                              k_block_size=k_block_size)
+    nbad = np.sum(~Sk_report['positive'])
+    if nbad > 0:
+        print('get_interpolated_bands_3: Sk not positive definite at {0:d} k-points'.format(nbad))
+
+    Kpath1 = np.array(Kpath)/(2*np.pi/model.alat)
     output_dir = os.path.dirname(HR_mat_path)
-    band_plot_2(output_dir,Kpath1,Ek,cell_type,Hk_space,fig_erange)
-
-    return
-def band_plot_2(fpath,Kpath1,Ek,cell_type,Hk_space,erange=[-20,10]):
-    
-    nkpnts = Ek.shape[1]
-    nbnds  = Ek.shape[0]
-    nspin  = Ek.shape[2]
+    with utils.profile_step('plot'):
+        band_plot_3(output_dir,Kpath1,np.transpose(Ek,(2,0,1)),model.cell_type,model.Hk_space,fig_erange,
+                    text=bands_text)
+    if orbitals_l is not None:
+        #weights[nawf,nk,nspin,ngroups], as Ek[nawf,nk,nspin]
+        utils.save_data_1(os.path.join(output_dir,'bands_proj.npz'),Kpath=Kpath1,Ek=np.transpose(Ek,(2,0,1)),
+                          weights=np.transpose(weights,(2,0,1,3)),labels=labels,proj_method=proj_method)
+
+    return Sk_report
+def get_band_velocities_1(eigval,vec,dHk,dSk=None,deg_tol=1e-4):
+    """
+    Band velocities dE_n/dk_alpha = <c_n|dH/dk_alpha - E_n dS/dk_alpha|c_n>
+    (Hellmann-Feynman) from the S-orthonormal eigenvectors vec[nk,nawf,nawf]
+    (columns) and dHk,dSk[3,nk,nawf,nawf] (get_Hk_from_HR_1 with deriv).
+    Within a group of bands degenerate to deg_tol (eV) the states are the
+    eigenvectors of one fixed generic combination of the three matrices
+    dH/dk_alpha - E dS/dk_alpha in the group, and vk of every band is the
+    3-vector of expectation values in the same state (for a degeneracy that
+    is split linearly, the velocity of the band leaving the degeneracy
+    along that direction).
+    returns vk[nk,nawf,3] in eV*Bohr
+    """
+    nk,nawf = eigval.shape
+    vecH = np.conj(np.swapaxes(vec,1,2))
+    M    = np.matmul(np.matmul(vecH[None],dHk),vec[None])       #[3,nk,nawf,nawf]
+    if dSk is not None:
+        M -= eigval[None,:,None,:]*np.matmul(np.matmul(vecH[None],dSk),vec[None])
+    vk = np.transpose(np.real(np.diagonal(M,axis1=2,axis2=3)),(1,2,0)).copy()
+
+    degen = np.diff(eigval,axis=1) < deg_tol
+    deg_dir = np.array([1.0,np.sqrt(2.0)/2,np.pi/7])   #no special direction of the lattice
+    for ik in np.where(np.any(degen,axis=1))[0]:
+        ib = 0
+        while ib < nawf:
+            jb = ib+1
+            while jb < nawf and degen[ik,jb-1]:
+                jb += 1
+            if jb-ib > 1:
+                aux = 0.5*(M[:,ik,ib:jb,ib:jb]+np.conj(np.swapaxes(M[:,ik,ib:jb,ib:jb],1,2)))
+                _,u = la.eigh(np.tensordot(deg_dir,aux,axes=1))
+                vk[ik,ib:jb,:] = np.transpose(np.real(np.einsum('ai,xab,bi->xi',np.conj(u),aux,u)))
+            ib = jb
+    return vk
+@utils.profile_stage('export_interpolated_eigs_1')
+def export_interpolated_eigs_1(HR_mat_path,kpnts,out_dir,chunk_size=10000,nthreads=4,eigvec=False,restart=True,
+                               velocity=False,k_block_size=1000):
+    """
+    Eigenvalues (and eigenvectors) of the H(R) model on an arbitrary list
+    of k-points, written to preallocated memory-mapped .npy files in out_dir:
+        kpnts.npy[nk,3] (crystal coordinates), Ek.npy[nk,nspin,nawf] (eV),
+        vec.npy[nk,nspin,nawf,nawf] if eigvec,
+        vk.npy[nk,nspin,nawf,3] (eV*Bohr) if velocity, nbad.npy[nchunks] (k-points
+        with S(k) not positive definite), done.npy[nchunks],
+        HR_hash.npy (utils.hash_path_1 of HR_mat_path)
+    The k-points are processed in chunks of chunk_size on a pool of nthreads
+    threads (numpy's BLAS/LAPACK calls release the GIL); each thread
+    diagonalizes its chunk in blocks of k_block_size k-points (TBModel.eig).
+    A chunk is marked in done.npy after its results are flushed, so with
+    restart=True an interrupted run on the same k-points and the same H(R)
+    only computes the missing chunks.
+    kpnts: array[nk,3] or text file of k-points in crystal coordinates, or
+           (nk1,nk2,nk3) for the regular unshifted grid
+    returns utils.load_data_1(out_dir)
+    """
+    from multiprocessing.pool import ThreadPool
+    fname = utils.fname()
+
+    if isinstance(kpnts,str):
+        kpnts = np.loadtxt(kpnts,ndmin=2)[:,:3]
+    elif np.size(kpnts) == 3 and np.ndim(kpnts) == 1:
+        nk    = np.array(kpnts,dtype=int)
+        kpnts = np.indices(nk).reshape((3,-1)).T/nk
+    kpnts = np.asarray(kpnts,dtype=float)
+
+    model   = TBModel(HR_mat_path)
+    HR_hash = utils.hash_path_1(HR_mat_path)
+    nspin   = model.nspin
+    nawf    = model.nawf
+    nk      = len(kpnts)
+    nchunks = -(-nk//chunk_size)
+
+    shapes  = {'kpnts':((nk,3),float),'Ek':((nk,nspin,nawf),float),'nbad':((nchunks,),int),
+               'done':((nchunks,),bool)}
+    if eigvec:
+        shapes['vec'] = ((nk,nspin,nawf,nawf),complex)
+    if velocity:
+        shapes['vk']  = ((nk,nspin,nawf,3),float)
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    out  = {}
+    mode = 'r+'
+    for key in shapes:
+        fout = os.path.join(out_dir,key+'.npy')
+        if not (restart and os.path.isfile(fout)):
+            mode = 'w+'
+            break
+        out[key] = np.load(fout,mmap_mode='r+')
+        if out[key].shape != shapes[key][0] or out[key].dtype != shapes[key][1]:
+            mode = 'w+'
+            break
+    if mode == 'r+' and not np.array_equal(out['kpnts'],kpnts):
+        mode = 'w+'
+    hash_file = os.path.join(out_dir,'HR_hash.npy')
+    if mode == 'r+' and not (os.path.isfile(hash_file) and str(np.load(hash_file)) == HR_hash):
+        print('{0:s}: {1:s} was computed with another H(R), starting over'.format(fname,out_dir))
+        mode = 'w+'
+    if mode == 'w+':
+        out = {}
+        for key in shapes:
+            out[key] = np.lib.format.open_memmap(os.path.join(out_dir,key+'.npy'),mode='w+',
+                                                 dtype=shapes[key][1],shape=shapes[key][0])
+        out['kpnts'][...] = kpnts
+        out['kpnts'].flush()
+        np.save(hash_file,np.array(HR_hash))
+
+    todo = [ichunk for ichunk in range(nchunks) if not out['done'][ichunk]]
+    print('{0:s}: {1:d} k-points in {2:d} chunks, {3:d} to compute'.format(fname,nk,nchunks,len(todo)))
+
+    def run_chunk(ichunk):
+        clock   = utils.profile_worker(thread=True)
+        ik0,ik1 = ichunk*chunk_size,min((ichunk+1)*chunk_size,nk)
+        Ek,vec,vk,report = model.eig(kpnts[ik0:ik1],eigvec=eigvec,velocity=velocity,k_block_size=k_block_size)
+        out['Ek'][ik0:ik1] = Ek
+        out['nbad'][ichunk] = np.sum(~report['positive'])
+        if eigvec:
+            out['vec'][ik0:ik1] = vec
+            out['vec'].flush()
+        if velocity:
+            out['vk'][ik0:ik1] = vk
+            out['vk'].flush()
+        out['Ek'].flush()
+        out['nbad'].flush()
+        out['done'][ichunk] = True
+        out['done'].flush()
+        return clock.stats(ichunk=ichunk)
+
+    utils.set_profile_info_1(nk=nk,nchunks=len(todo),nthreads=nthreads)
+    pool = ThreadPool(processes = nthreads)
+    utils.add_profile_workers_1(pool.map(run_chunk,todo))
+    pool.close()
+    pool.join()
+    nbad = np.sum(out['nbad'])
+    if nbad > 0:
+        print('{0:s}: Sk not positive definite at {1:d} k-points'.format(fname,nbad))
+    print('{0:s}: Saving data in {1:s}'.format(fname,out_dir))
+    out.clear()
+    return utils.load_data_1(out_dir)
+def get_path_distance_1(Kpath):
+    """
+    Cumulative length along the k-path Kpath[nk,3] (the x axis of the bands)
+    """
+    dk = np.zeros(len(Kpath))
+    dk[1:] = np.cumsum(la.norm(np.diff(Kpath,axis=0),axis=1))
+    return dk
+def band_plot_3(fpath,Kpath1,Ek,cell_type,Hk_space,erange=[-20,10],text=False,plot=True):
+    """
+    band_plot_3: saves the bands in binary form and writes all the spin
+                 channels (band_plot_2 wrote the last one only)
+    Ek[nbnds,nk,nspin] along Kpath1[nk,3] are saved with the cumulative
+    k-distance dk in bands_<Hk_space>_<cell>.npz (utils.load_data_1).
+    text: also writes the gnuplot files bands<_up|_dn>_<Hk_space>_<cell>.txt
+    plot: figure of every spin channel, drawn from the arrays (lib_plot)
+    """
+    fname = utils.fname()
+    nbnds,nkpnts,nspin = Ek.shape
 
     if cell_type.lower() == 'wigner-seitz':
        cell_type_label = 'ws'
     else:
        cell_type_label = cell_type.lower()
+    if nspin == 1:
+        suffixes = ['']
+    elif nspin == 2:
+        suffixes = ['_up','_dn']
+    else:
+        sys.exit('{0:s}: nspin={1:d} case not contemplated'.format(fname,nspin))
+
+    dk = get_path_distance_1(Kpath1)
+    label = '_'+Hk_space+'_'+cell_type_label
+    datafile = os.path.join(fpath,'bands'+label+'.npz')
+    utils.save_data_1(datafile,Kpath=Kpath1,dk=dk,Ek=Ek)
+    print('{0:s}: Bands saved to {1:s}'.format(fname,datafile))
+
+    if text:
+        #one block of nk lines "dk E" per band, blocks separated by ' '
+        block = '\n'.join(['%f %f']*nkpnts)+'\n \n'
+        aux = np.empty((nbnds,nkpnts,2))
+        aux[:,:,0] = dk
+        for ispin in range(nspin):
+            aux[:,:,1] = Ek[:,:,ispin]
+            textfile = os.path.join(fpath,'bands'+suffixes[ispin]+label+'.txt')
+            with open(textfile,'w') as fid:
+                fid.write((block*nbnds) % tuple(aux.ravel()))
 
-    for ispin in range(nspin):
-        if nspin==1:
-            suffix=''
-        else:
-            if ispin == 1:
-                suffix='_up'
-            elif ispin == 2:
-                suffix='_dn'
-            else:
-                sys.exit('ispin case not contemplated')
-    datafile = os.path.join(fpath, 'bands'+suffix+'_'+Hk_space+'_'+cell_type_label+'.txt')
-    fid = open(datafile , 'w')
-    for ibnd in range(nbnds):
-        dk = 0.0
-        for ik in range(nkpnts):
-            if ik==0: k0=Kpath1[ik,:]
-            a  = Kpath1[ik,:] - k0
-            dk = dk + la.norm(a)
-            print('{0:f} {1:f}'.format(dk,Ek[ibnd,ik,ispin]),file=fid)
-            k0 = Kpath1[ik,:]
-        print(' ',file=fid)
-    fid.close()
-
-    bands = mutils.read_gnuplot_data(datafile,sep_str='\n \n')
-    nbnds = len(bands)
-    fig=plt.figure()
-    for i in range(nbnds):
-          x = bands[i][:,0]
-          y = bands[i][:,1]
-          plt.plot(range(len(x)),y,'.-',linewidth=0.1)
-
-    plt.xlabel('k-points')
-    plt.ylabel('Energy - E$_F$ (eV)')
-    plt.ylim(erange[0],erange[1])
-
-    plt.gca().grid(True)
-    pdffile = os.path.splitext(datafile)[0]+'.pdf'
-    print('band_plot_2: A figure has been saved to {0:s}'.format(pdffile))
-    plt.savefig(pdffile,format='pdf')
-    return
-def build_Hk_5(QE_xml_data_file,shift,shift_type,Hk_space,Hk_outfile,nbnds_norm=0,nbnds_in=0):
+    if plot:
+        import lib_plot
+        for ispin in range(nspin):
+            pdffile = os.path.join(fpath,'bands'+suffixes[ispin]+label+'.pdf')
+            lib_plot.plot_bands_1(Ek[:,:,ispin],pdffile,erange)
+            print('{0:s}: A figure has been saved to {1:s}'.format(fname,pdffile))
+@utils.profile_stage('build_Hk_5')
+def build_Hk_5(QE_xml_data_file,shift,shift_type,Hk_space,Hk_outfile,nbnds_norm=0,nbnds_in=0,use_cache=True):
     """
     returns Hk:
     build_Hk_2: includes all the bands that lay under the 'shift' energy.
@@ -363,12 +1206,22 @@ def build_Hk_5(QE_xml_data_file,shift,shift_type,Hk_space,Hk_outfile,nbnds_norm=
     build_Hk_4: -a bug for nonortho shifting is corrected: Sks was needed for that case.
                 -changed the name of the output variable from Hks to Hk.
     build_Hk_5: reads nawf,nkpnts,nspin,shift,eigsmat, from QE_xml_data_file
+    use_cache: skip the calculation if Hk_outfile was built from the same
+               inputs and parameters (see utils.check_stage_cache_1).
     """
-    nproc = 1
+    fname = utils.fname()
 
-    if not os.path.isfile(QE_xml_data_file):
+    if not os.path.exists(QE_xml_data_file):
         sys.exit('File not found: {0:s}'.format(QE_xml_data_file))
-    data      = np.load(QE_xml_data_file)
+
+    stage_inputs = [QE_xml_data_file]
+    stage_params = {'shift':shift,'shift_type':shift_type,'Hk_space':Hk_space.lower(),
+                    'nbnds_norm':nbnds_norm,'nbnds_in':nbnds_in}
+    stage_digest = utils.stage_hash_1(fname,stage_inputs,stage_params)
+    if utils.check_stage_cache_1(fname,Hk_outfile,stage_digest,use_cache=use_cache):
+        return utils.load_data_1(Hk_outfile)['Hk']
+
+    data      = utils.load_data_1(QE_xml_data_file)
     nawf      = int(data['nawf'])
     nkpnts    = int(data['nkpnts'])
     nspin     = int(data['nspin'])
@@ -384,84 +1237,514 @@ def build_Hk_5(QE_xml_data_file,shift,shift_type,Hk_space,Hk_outfile,nbnds_norm=
     else:
        sys.exit('wrong Hk_space option. Only ortho and nonortho are accepted')
 
-    tic = time.time()
+    if nbnds_in < 0:
+       sys.exit('build_Hk_5: wrong nbnd variable')
+    if shift_type not in [0,1]:
+       sys.exit('shift_type not recognized')
+
+    kappa = shift
+    nbnds = eigsmat.shape[0]
+    utils.set_profile_info_1(Hk_space=Hk_space.lower(),nkpnts=nkpnts,nawf=nawf,nbnds=nbnds,nspin=nspin)
     Hks = np.zeros((nawf,nawf,nkpnts,nspin),dtype=complex)
-    for ispin in range(nspin):
-        for ik in range(nkpnts):
-            my_eigs=eigsmat[:,ik,ispin]
-            E = np.diag(my_eigs)
-            UU    = U[:,:,ik,ispin] #transpose of U. Now the columns of UU are the eigenvector of length nawf
+
+    if Hk_space.lower()=='nonortho':
+        #S^(1/2) from one batched Hermitian eigendecomposition of all S(k)
+        with utils.profile_step('S^1/2'):
+            Sk_stack  = np.transpose(Sks,(2,0,1))
+            eigS,vecS = la.eigh(Sk_stack)
+            Sk_half   = np.matmul(vecS*np.sqrt(eigS.astype(complex))[:,None,:],
+                                  np.conj(np.swapaxes(vecS,1,2)))
+
+    with utils.profile_step('Hk build'):
+        for ispin in range(nspin):
+            #columns of A[ik] are the projected eigenvectors of length nawf
+            #a copy: U may be a read-only memory map and is not to be modified
+            A = np.array(np.transpose(U[:,:,:,ispin],(2,0,1)))    #nkpnts x nawf x nbnds
             if nbnds_norm > 0:
-                norms = 1/np.sqrt(np.real(np.sum(np.conj(UU)*UU,axis=0)))
-                UU[:,:nbnds_norm] = UU[:,:nbnds_norm]*norms[:nbnds_norm]
-            kappa = shift
+                norms = 1/np.sqrt(np.real(np.sum(np.conj(A)*A,axis=1)))
+                A[:,:,:nbnds_norm] = A[:,:,:nbnds_norm]*norms[:,None,:nbnds_norm]
+
+            #the selected bands are kept as a mask, so every k has the same shape
+            my_eigs = np.transpose(eigsmat[:,:,ispin])  #nkpnts x nbnds
             if nbnds_in == 0:
-               iselect   = np.where(my_eigs <= shift)[0]
-            elif nbnds_in > 0:
-               iselect   = range(nbnds_in)
+                select = (my_eigs <= shift).astype(float)
             else:
-               sys.exit('build_Hk_4: wrong nbnd variable')
-
-            ac    = UU[:,iselect]
-            ee1   = E[np.ix_(iselect,iselect)]
-
-            if shift_type ==0:
-                Hks_aux = ac.dot(ee1).dot(np.conj(ac).T) + kappa*( -ac.dot(np.conj(ac).T))
-            elif shift_type==1:
-                aux_p=la.inv(np.dot(np.conj(ac).T,ac))
-                Hks_aux = ac.dot(ee1).dot(np.conj(ac).T) + kappa*( -ac.dot(aux_p).dot(np.conj(ac).T))
+                select = np.zeros((nkpnts,nbnds))
+                select[:,:nbnds_in] = 1.0
+            A  = A*select[:,None,:]
+            AH = np.conj(np.swapaxes(A,1,2))
+
+            if shift_type == 0:
+                #A (E-kappa) A^H
+                Hks_aux = np.matmul(A*(my_eigs-kappa)[:,None,:],AH)
             else:
-                sys.exit('shift_type not recognized')
-
-
-                Hks_aux = np.triu(Hks_aux,1)+np.diag(np.diag(Hks_aux))+np.conj(np.triu(Hks_aux,1)).T
+                #A E A^H - kappa A (A^H A)^-1 A^H; the bands left out are given
+                #a unit diagonal so that (A^H A) stays invertible
+                aux_p = la.inv(np.matmul(AH,A)+(1-select)[:,:,None]*np.eye(nbnds))
+                Hks_aux = np.matmul(A*my_eigs[:,None,:],AH) - kappa*np.matmul(np.matmul(A,aux_p),AH)
 
             if Hk_space.lower()=='ortho':
-                Hks[:,:,ik,ispin] = Hks_aux  + kappa*np.identity(nawf)
-            elif Hk_space.lower()=='nonortho':
-                Sk_half = sla.fractional_matrix_power(Sks[:,:,ik],0.5)
-                if 'multi_dot' in dir (la):
-                    Hks[:,:,ik,ispin] =la.multi_dot([Sk_half,Hks_aux,Sk_half])+kappa*Sks[:,:,ik]
-                else:
-                    Hks[:,:,ik,ispin] =np.dot(np.dot(Sk_half,Hks_aux),Sk_half)+kappa*Sks[:,:,ik]
+                Hks_aux = Hks_aux + kappa*np.identity(nawf)
+            else:
+                Hks_aux = np.matmul(np.matmul(Sk_half,Hks_aux),Sk_half) + kappa*Sk_stack
+            Hks[:,:,:,ispin] = np.transpose(Hks_aux,(1,2,0))
 
+    with utils.profile_step('write'):
+        utils.save_data_1(Hk_outfile,Hk=Hks,nbnds_norm=nbnds_norm,nbnds_in=nbnds_in,shift_type=shift_type,shift=shift)
+    utils.save_stage_hash_1(fname,Hk_outfile,stage_digest,stage_inputs,stage_params)
+    return Hks
+def get_real_ylm_1(l,u):
+    """
+    Real spherical harmonics of angular momentum l at the unit vectors
+    u[n,3], in the order of QE's ylmr2 (and of the atomic wavefunctions of
+    projwfc): m=0, then cos(m phi), sin(m phi) for m=1..l.
+    returns ylm[n,2l+1]
+    """
+    from scipy.special import lpmv
+    from math import factorial
+    cost = np.clip(u[:,2],-1.0,1.0)
+    phi  = np.arctan2(u[:,1],u[:,0])
+    c    = np.sqrt((2*l+1)/(4*np.pi))
+    ylm  = np.zeros((len(u),2*l+1))
+    ylm[:,0] = c*lpmv(0,l,cost)
+    for m in range(1,l+1):
+        Q = np.sqrt(factorial(l-m)/factorial(l+m))*lpmv(m,l,cost) #includes (-1)^m
+        ylm[:,2*m-1] = c*np.sqrt(2.0)*Q*np.cos(m*phi)
+        ylm[:,2*m]   = c*np.sqrt(2.0)*Q*np.sin(m*phi)
+    return ylm
+def get_ylm_rotation_1(l,S):
+    """
+    Rotation matrix D[2l+1,2l+1] of the real spherical harmonics
+    (get_real_ylm_1) under the cartesian (proper or improper) rotation S:
+        Y_lm(S^-1 u) = sum_m' Y_lm'(u) D[m',m]
+    obtained by least squares on a fixed set of directions.
+    """
+    u   = np.random.RandomState(0).randn(4*(2*l+1),3)
+    u   = u/la.norm(u,axis=1)[:,None]
+    D,_,_,_ = la.lstsq(get_real_ylm_1(l,u),get_real_ylm_1(l,np.dot(u,S)),rcond=None)
+    return D
+def get_space_group_ops_1(symop,ftau,nsym,a_vectors,atoms_coords,atoms_species,eps=1e-5):
+    """
+    Cartesian space-group operations {S|f} (r -> S r + f) from the crystal
+    rotations symop and fractional translations ftau of data-file.xml.
+    Both the QE convention and its transpose/inverse are tried; an operation
+    is kept if S is orthogonal and maps every atom a onto an atom perm[a] of
+    the same species: S tau_a + f = tau_perm[a] + L_a.
+    returns a list of (S,f,perm,L) with L[natoms,3] lattice vectors, all in Bohrs
+    """
+    fname  = utils.fname()
+    A      = np.asarray(a_vectors)
+    Ainv   = la.inv(A)
+    tau    = np.asarray(atoms_coords)
+    natoms = len(tau)
+    species= np.asarray(atoms_species)
+    ops    = []
+    for isym in range(nsym):
+        s = np.asarray(symop[isym],dtype=float)
+        found = False
+        for sc in [s,np.transpose(s),la.inv(s),np.transpose(la.inv(s))]:
+            S = np.dot(np.dot(np.transpose(A),sc),np.transpose(Ainv)) #x' = sc x, r = A^T x
+            if np.max(np.abs(np.dot(S,S.T)-np.eye(3))) > eps:
+                continue
+            for fc in [ftau[isym],-np.asarray(ftau[isym])]:
+                f    = np.dot(fc,A)
+                perm = np.zeros(natoms,dtype=int)
+                L    = np.zeros((natoms,3))
+                for ia in range(natoms):
+                    new  = np.dot(S,tau[ia])+f
+                    frac = np.dot(new[None,:]-tau,Ainv) #crystal coordinates of new - tau_b
+                    ib   = np.where(np.logical_and(np.all(np.abs(frac-np.rint(frac)) < eps,axis=1),
+                                                   species == species[ia]))[0]
+                    if len(ib) != 1:
+                        break
+                    perm[ia] = ib[0]
+                    L[ia]    = np.dot(np.rint(frac[ib[0]]),A)
+                else:
+                    ops.append((S,f,perm,L))
+                    found = True
+                    break
+            if found:
+                break
+        if not found:
+            print('{0:s}: WARNING!!, symmetry operation {1:d} does not map the crystal onto itself,'
+                  ' skipping it'.format(fname,isym+1))
+    return ops
+def get_atoms_orbitals_l_1(data_file):
+    """
+    Angular momenta of the atomic wavefunctions of every atom, in the order
+    of projwfc, from the PP_CHI l-data of the pseudopotentials of
+    data-file.xml (chi with negative occupation are not projected on).
+    returns orbitals_l: list (one per atom) of lists of l
+    """
+    import lib_upf
+    aux     = read_QE_data_file_xml_v2(data_file)
+    chi_l   = {}
+    for itype,ipsp in zip(aux['itype'],aux['ipsp']):
+        psp = lib_upf.read_UPF(ipsp)
+        chi_l[itype] = [l for l,oc in zip(psp['PP_PSWFC']['PP_CHI_l'],psp['PP_PSWFC']['PP_CHI_occupation'])
+                        if oc >= 0]
+    return [chi_l[species] for species in aux['atoms_species']]
+@utils.profile_stage('unfold_Hk_IBZ_1')
+def unfold_Hk_IBZ_1(QE_xml_data_file,Hk_file,QE_full_data_file,Hk_full_file,nk1,nk2,nk3,orbitals_l,
+                    eps=1e-5,use_cache=True):
+    """
+    Unfolds H(k) and S(k) of an irreducible-wedge calculation onto the full,
+    unshifted nk1 x nk2 x nk3 grid, so that build_HR_par_6 can be run on
+    QE_full_data_file and Hk_full_file.
+    For a space-group operation {S|f} with atom permutation perm and lattice
+    vectors L (get_space_group_ops_1), in the basis of Bloch sums
+    sum_R exp(ik.R) phi(r-tau-R):
+        H(Sk) = U H(k) U^H,   U[perm[b]-block,b-block] = D(S)_b exp(-i Sk.L_b)
+    where D(S)_b is block diagonal in the angular-momentum rotations
+    (get_ylm_rotation_1) of the orbitals of atom b. With time-reversal
+    symmetry H(-Sk) = conj(H(Sk)) is used as well.
+    orbitals_l: list (one per atom) of the l of its atomic wavefunctions,
+                e.g. from get_atoms_orbitals_l_1
+    returns Hk[nawf,nawf,nk,nspin] on the full grid
+    """
+    fname = utils.fname()
+    stage_inputs = [QE_xml_data_file,Hk_file]
+    stage_params = {'nk':[nk1,nk2,nk3],'orbitals_l':[[int(l) for l in aux] for aux in orbitals_l]}
+    stage_digest = utils.stage_hash_1(fname,stage_inputs,stage_params)
+    if utils.check_stage_cache_1(fname,Hk_full_file,stage_digest,use_cache=use_cache) and \
+       os.path.exists(QE_full_data_file):
+        return utils.load_data_1(Hk_full_file)['Hk']
+
+    data      = utils.load_data_1(QE_xml_data_file)
+    for key in ['atoms_coords','ftau']:
+        if key not in data:
+            sys.exit('{0:s}: {1:s} not found in {2:s}; rerun read_QE_output_xml_v4 '
+                     'with use_cache=False'.format(fname,key,QE_xml_data_file))
+    alat      = float(data['alat'])
+    a_vectors = data['a_vectors']
+    kpnts     = data['kpnts']
+    kpnts_wght= data['kpnts_wght']
+    Sk        = data['Sk']
+    Hk        = utils.load_data_1(Hk_file)['Hk']
+    nawf,_,nkpnts,nspin = Hk.shape
+    if 'time_reversal' in data:
+        time_reversal = bool(data['time_reversal'])
+    else:
+        time_reversal = False
+
+    atoms_coords = data['atoms_coords']
+    ops = get_space_group_ops_1(data['symop'],data['ftau'],int(data['nsym']),a_vectors,atoms_coords,
+                                data['atoms_species'],eps=eps)
+
+    norb    = [int(np.sum([2*l+1 for l in aux])) for aux in orbitals_l]
+    orb_ptr = np.concatenate(([0],np.cumsum(norb))).astype(int)
+    if len(orbitals_l) != len(atoms_coords) or orb_ptr[-1] != nawf:
+        sys.exit('{0:s}: orbitals_l does not match natoms and nawf = {1:d}'.format(fname,nawf))
+
+    nk      = np.array([nk1,nk2,nk3])
+    nkfull  = nk1*nk2*nk3
+    Hk_full = np.zeros((nawf,nawf,nkfull,nspin),dtype=complex)
+    Sk_full = np.zeros((nawf,nawf,nkfull),dtype=complex)
+    filled  = np.zeros(nkfull,dtype=bool)
+    Hk_ibz  = np.transpose(Hk,(2,3,0,1))  #nk,nspin,nawf,nawf
+    Sk_ibz  = np.transpose(Sk,(2,0,1))
+
+    for S,f,perm,L in ops:
+        #orbital rotation: block of atom ia -> block of atom perm[ia]
+        D = np.zeros((nawf,nawf))
+        for ia in range(len(norb)):
+            ib  = perm[ia]
+            off = 0
+            for l in orbitals_l[ia]:
+                D[orb_ptr[ib]+off:orb_ptr[ib]+off+2*l+1,orb_ptr[ia]+off:orb_ptr[ia]+off+2*l+1] = \
+                    get_ylm_rotation_1(l,S)
+                off += 2*l+1
+        Skpnts = np.dot(kpnts,np.transpose(S))                         #S k, in 2pi/alat
+        phase  = np.exp(-2j*np.pi/alat*np.dot(Skpnts,np.transpose(L))) #nk,natoms
+        U      = D[None,:,:]*np.repeat(phase,norb,axis=1)[:,None,:]
+        UH     = np.conj(np.swapaxes(U,1,2))
+        for sign in ([1,-1] if time_reversal else [1]):
+            aux   = sign*np.dot(Skpnts,np.transpose(a_vectors))/alat*nk
+            kint  = np.rint(aux).astype(int)
+            ongrid= np.all(np.abs(aux-kint) < eps*np.max(nk),axis=1)
+            ifull = np.ravel_multi_index(tuple(np.mod(kint,nk).T),tuple(nk))
+            new   = np.where(np.logical_and(ongrid,~filled[ifull]))[0]
+            new   = new[np.unique(ifull[new],return_index=True)[1]]
+            if len(new) == 0:
+                continue
+            Hrot = np.matmul(np.matmul(U[new,None],Hk_ibz[new]),UH[new,None])
+            Srot = np.matmul(np.matmul(U[new],Sk_ibz[new]),UH[new])
+            if sign == -1:
+                Hrot = np.conj(Hrot)
+                Srot = np.conj(Srot)
+            Hk_full[:,:,ifull[new],:] = np.transpose(Hrot,(2,3,0,1))
+            Sk_full[:,:,ifull[new]]   = np.transpose(Srot,(1,2,0))
+            filled[ifull[new]] = True
+
+    if not np.all(filled):
+        sys.exit('{0:s}: {1:d} k-points of the full grid could not be reached from the irreducible'
+                 ' wedge with {2:d} symmetry operations'.format(fname,np.sum(~filled),len(ops)))
+
+    kint       = np.array(np.unravel_index(np.arange(nkfull),tuple(nk))).T
+    B          = alat*np.transpose(la.inv(a_vectors))   #rows b_i in 2pi/alat
+    kpnts_full = np.dot(kint/nk,B)
+    kpnts_wght_full = np.ones(nkfull)*np.sum(kpnts_wght)/nkfull
+
+    print('{0:s}: Unfolded {1:d} k-points onto the {2:d}x{3:d}x{4:d} grid with {5:d} symmetry operations'
+          .format(fname,nkpnts,nk1,nk2,nk3,len(ops)))
+
+    full_data = dict([(key,data[key]) for key in data.keys() if key not in ['U','eigsmat']])
+    full_data.update({'kpnts':kpnts_full,'kpnts_wght':kpnts_wght_full,'nkpnts':nkfull,'Sk':Sk_full})
+    utils.save_data_1(QE_full_data_file,**full_data)
+    utils.save_data_1(Hk_full_file,Hk=Hk_full)
+    utils.save_stage_hash_1(fname,Hk_full_file,stage_digest,stage_inputs,stage_params)
+    return Hk_full
+def set_atomic_proj_elem_1(proj,tags,elem):
+    """
+    Decodes one EIG, ATMWFC or OVERLAP element of atomic_proj.xml into the
+    preallocated proj['eigsmat'], proj['U'] or proj['Sk'] (skipped if None).
+    tags: tags of the path from the section to elem, e.g.
+          ['PROJECTIONS','K-POINT.3','SPIN.1','ATMWFC.2']
+    """
+    section = tags[0]
+    if len(tags) < 3:
+        return
+    if section == 'EIGENVALUES' and proj['eigsmat'] is not None and tags[2].startswith('EIG'):
+        ik    = int(tags[1].split('.')[1])-1
+        ispin = int(tags[2].split('.')[1])-1 if '.' in tags[2] else 0
+        if elem.attrib['type'] != 'real':
+            sys.exit('Reading eigenvalues that are not real numbers')
+        eigk = utils.xml_text2array(elem.text)
+        proj['eigsmat'][:,ik,ispin] = eigk*Ry2eV-proj['Efermi'] #meigs in eVs and wrt Ef
+    elif section == 'PROJECTIONS' and proj['U'] is not None and elem.tag.startswith('ATMWFC'):
+        ik    = int(tags[1].split('.')[1])-1
+        ispin = int(tags[2].split('.')[1])-1 if tags[2].startswith('SPIN') else 0
+        iin   = int(elem.tag.split('.')[1])-1
+        if elem.attrib['type'] not in ['real','complex']:
+            sys.exit('neither real nor complex??')
+        proj['U'][iin,:,ik,ispin] = utils.xml_text2array(elem.text,elem.attrib['type'])
+    elif section == 'OVERLAPS' and proj['Sk'] is not None and elem.tag == 'OVERLAP.1':
+        nawf= proj['nawf']
+        ik  = int(tags[1].split('.')[1])-1
+        if elem.attrib['type'] != 'complex':
+            sys.exit('the overlaps are assumed to be complex numbers')
+        aux = utils.xml_text2array(elem.text,'complex')
+        if len(aux) != nawf**2:
+            sys.exit('wrong number of elements when reading the S matrix')
+        Sks_aux = aux.reshape((nawf,nawf),order='F')
+        proj['Sk'][:,:,ik] = np.triu(Sks_aux,1)+np.diag(np.diag(Sks_aux))+np.conj(np.triu(Sks_aux,1)).T
+def read_atomic_proj_xml_stream_1(atomic_proj,read_eigs=True,read_U=False,read_S=False,header_only=False):
+    """
+    One-pass streaming reader of atomic_proj.xml built on ET.iterparse.
+    The HEADER is read first, then U, Sk and eigsmat are preallocated and
+    filled as each EIG, ATMWFC and OVERLAP element is closed. Processed
+    elements are cleared and detached from the tree, so peak memory is
+    about the size of the output arrays.
+    header_only: stop at the first EIGENVALUES/PROJECTIONS/OVERLAPS section
+    returns a dictionary with nkpnts, nspin, kunits, kpnts, kpnts_wght, nbnds,
+            Efermi, Efermi_units, nawf, eigsmat, U, Sk
+    """
+    fname = utils.fname()
+
+    header = {}
+    proj   = {'eigsmat':None,'U':None,'Sk':None}
+    estack = []
+    for event,elem in ET.iterparse(atomic_proj,events=('start','end')):
+        if event == 'start':
+            if header_only and elem.tag in ['EIGENVALUES','PROJECTIONS','OVERLAPS']:
+                break
+            estack.append(elem)
+            continue
+        estack.pop()
+        tags = [e.tag for e in estack[1:]] + [elem.tag]
+        section = tags[0]
+
+        if section == 'HEADER':
+            if elem.tag == 'HEADER':
+                nkpnts = int(header['NUMBER_OF_K-POINTS'].text.strip())
+                nspin  = int(header['NUMBER_OF_SPIN_COMPONENTS'].text.split()[0])
+                nbnds  = int(header['NUMBER_OF_BANDS'].text.split()[0])
+                nawf   = int(header['NUMBER_OF_ATOMIC_WFC'].text.split()[0])
+                if header['UNITS_FOR_ENERGY'].attrib['UNITS'] != 'Rydberg':
+                    sys.exit('{0:s}: Energy units has to be in Rydbers'.format(fname))
+                Efermi = float(header['FERMI_ENERGY'].text.split()[0])*Ry2eV
+                proj.update({'nkpnts':nkpnts,'nspin':nspin,'nbnds':nbnds,'nawf':nawf,
+                             'kunits':header['UNITS_FOR_K-POINTS'].attrib['UNITS'],
+                             'Efermi':Efermi,'Efermi_units':'eV'})
+                print('{0:s}: nkpnts = {1:d}, nspin = {2:d}, nbnds = {3:d}, nawf = {4:d}, '
+                      'Efermi = {5:f} (eV)'.format(fname,nkpnts,nspin,nbnds,nawf,Efermi))
+                if read_eigs:
+                    proj['eigsmat'] = np.zeros((nbnds,nkpnts,nspin))
+                if read_U:
+                    proj['U']       = np.zeros((nawf,nbnds,nkpnts,nspin),dtype=complex)
+                if read_S:
+                    proj['Sk']      = np.zeros((nawf,nawf,nkpnts),dtype=complex)
+                elem.clear()
             else:
-                sys.exit('wrong Hk_space option. Only ortho and nonortho are accepted')
+                header[elem.tag] = elem
+            continue
+
+        if elem.tag == 'K-POINTS':
+            proj['kpnts'] = utils.xml_text2array(elem.text,shape=(nkpnts,3))
+        elif elem.tag == 'WEIGHT_OF_K-POINTS':
+            proj['kpnts_wght'] = utils.xml_text2array(elem.text)
+            if proj['kpnts_wght'].shape[0] != nkpnts:
+                sys.exit('Error in size of the kpnts_wght vector')
+        else:
+            with utils.profile_step('decode'):
+                set_atomic_proj_elem_1(proj,tags,elem)
 
+        elem.clear()
+        if len(tags) == 2:
+            estack[-1].remove(elem)
 
-    
-    np.savez(Hk_outfile,Hk=Hks,nbnds_norm=nbnds_norm,nbnds_in=nbnds_in,shift_type=shift_type,shift=shift)
-            
-    toc = time.time()
-    hours, rem = divmod(toc-tic, 3600)
-    minutes, seconds = divmod(rem, 60)
-    print("Parallel calculation of H[k] with {0:d} processors".format(nproc))
-    print("Elapsed time {:0>2}:{:0>2}:{:05.2f}".format(int(hours),int(minutes),seconds))
-    return Hks
-def read_eigenvalues_xml_par(nkpnts,Efermi,nspin,ispin,root,nproc):
-    from multiprocessing import Pool
-    pool       = multiprocessing.Pool(processes = nproc)
-    partial_read_eigenvalues = partial(read_eigenvalues_xml,Efermi=Efermi,nspin=nspin,ispin=ispin,root=root)
-    my_eigsmat = pool.map(partial_read_eigenvalues,xrange(nkpnts))
-    pool.close()
-    pool.join()
-    return my_eigsmat
-def read_projections_xml_par(nkpnts,nawf,nbnds,nspin,ispin,root,nproc):
-    from multiprocessing import Pool
-    pool       = multiprocessing.Pool(processes = nproc)
-    partial_read_projections= partial(read_projections_xml,nawf=nawf,nbnds=nbnds,nspin=nspin,ispin=ispin,root=root)
-    Uaux = pool.map(partial_read_projections,xrange(nkpnts))
-    pool.close()
-    pool.join()
-    return Uaux
-def read_overlap_xml_par(nkpnts,nawf,root,nproc):
-    from multiprocessing import Pool
-    pool       = multiprocessing.Pool(processes = nproc)
-    partial_read_overlap = partial(read_overlap_xml,nawf=nawf,root=root)
-    Sks = pool.map(partial_read_overlap,xrange(nkpnts))
-    pool.close()
-    pool.join()
-    return Sks
+    return proj
+def index_atomic_proj_xml_1(atomic_proj,chunk_size=2**26):
+    """
+    Scans atomic_proj.xml (as bytes, in chunks) for the byte offsets of every
+    <K-POINT.n> ... </K-POINT.n> block of the EIGENVALUES, PROJECTIONS and
+    OVERLAPS sections (the tags may carry attributes).
+    returns {section: offsets[nkpnts,2]}, with [start,end) of each block
+    """
+    fname = utils.fname()
+    pattern = re.compile(b'<(/?)(K-POINT\\.(\\d+)|EIGENVALUES|PROJECTIONS|OVERLAPS)(?:\\s[^>]*)?>')
+    ntail   = 4096  #longer than any tag
+    blocks  = {}
+    section = None
+    with open(atomic_proj,'rb') as fid:
+        offset = 0
+        tail   = b''
+        while True:
+            chunk = fid.read(chunk_size)
+            eof   = not chunk
+            data  = tail + chunk
+            base  = offset - len(tail)
+            keep  = len(data)-ntail
+            for match in pattern.finditer(data):
+                if match.end() > len(data)-ntail and not eof:
+                    keep = match.start()  #may continue in the next chunk
+                    break
+                keep  = max(keep,match.end())
+                close = match.group(1) == b'/'
+                if match.group(3) is None:
+                    section = None if close else match.group(2).decode('ascii')
+                    if section is not None:
+                        blocks[section] = {}
+                elif section is not None:
+                    ik = int(match.group(3))-1
+                    if close:
+                        blocks[section][ik][1] = base + match.end()
+                    else:
+                        blocks[section][ik] = [base + match.start(),0]
+            if eof:
+                break
+            offset += len(chunk)
+            tail    = data[max(keep,0):]
+
+    for section in blocks:
+        nkpnts = len(blocks[section])
+        blocks[section] = np.array([blocks[section][ik] for ik in range(nkpnts)],dtype=np.int64)
+        if np.any(blocks[section][:,1] <= blocks[section][:,0]):
+            sys.exit('{0:s}: Unclosed K-POINT block in {1:s}'.format(fname,section))
+    return blocks
+def read_atomic_proj_kblock_1(ik_range,atomic_proj,blocks,out_files,Efermi,nawf):
+    """
+    Worker of read_atomic_proj_xml_par_1: reads the K-POINT blocks ik_range
+    of every section in blocks directly from their byte offsets and writes
+    the decoded data into the shared output arrays in out_files
+    ({key: descriptor} for eigsmat, U and Sk, see utils.create_shared_array_1).
+    returns utils.profile_worker stats of the task
+    """
+    clock   = utils.profile_worker()
+    ik0,ik1 = ik_range
+    proj = {'Efermi':Efermi,'nawf':nawf,'eigsmat':None,'U':None,'Sk':None}
+    for key in out_files:
+        proj[key] = utils.attach_shared_array_1(out_files[key])
+
+    with open(atomic_proj,'rb') as fid:
+        for section in blocks:
+            start = blocks[section][ik0,0]
+            end   = blocks[section][ik1-1,1]
+            fid.seek(start)
+            root  = ET.fromstring(b'<'+section.encode('ascii')+b'>'+fid.read(end-start)+
+                                  b'</'+section.encode('ascii')+b'>')
+            for kpoint in root:
+                for elem in kpoint:
+                    if elem.tag.startswith('SPIN'):
+                        for subelem in elem:
+                            set_atomic_proj_elem_1(proj,[section,kpoint.tag,elem.tag,subelem.tag],subelem)
+                    else:
+                        set_atomic_proj_elem_1(proj,[section,kpoint.tag,elem.tag],elem)
+            del root
+
+    for key in out_files:
+        if proj[key] is not None:
+            proj[key].flush()
+    return clock.stats(nkpnts=ik1-ik0)
+def read_atomic_proj_xml_par_1(atomic_proj,read_eigs=True,read_U=False,read_S=False,nproc=2):
+    """
+    Parallel reader of atomic_proj.xml. The file is first scanned for the
+    byte offsets of each K-POINT block (index_atomic_proj_xml_1); each
+    worker then seeks to its own k-range, decodes it, and writes into
+    output arrays shared through memory-mapped files. No DOM is built or
+    sent to the workers. Same output as read_atomic_proj_xml_stream_1.
+    """
+    fname = utils.fname()
+
+    proj   = read_atomic_proj_xml_stream_1(atomic_proj,header_only=True)
+    nkpnts = proj['nkpnts']
+    nspin  = proj['nspin']
+    nbnds  = proj['nbnds']
+    nawf   = proj['nawf']
+
+    with utils.profile_step('index'):
+        blocks = index_atomic_proj_xml_1(atomic_proj)
+
+    sections = {}
+    out      = {}
+    if read_eigs:
+        sections['EIGENVALUES'] = 'eigsmat'
+        out['eigsmat'] = (float,(nbnds,nkpnts,nspin))
+    if read_U:
+        sections['PROJECTIONS'] = 'U'
+        out['U']       = (complex,(nawf,nbnds,nkpnts,nspin))
+    if read_S:
+        sections['OVERLAPS']    = 'Sk'
+        out['Sk']      = (complex,(nawf,nawf,nkpnts))
+
+    for section in sections:
+        if section not in blocks:
+            sys.exit('{0:s}: Section {1:s} not found in {2:s}'.format(fname,section,atomic_proj))
+        if len(blocks[section]) != nkpnts:
+            sys.exit('{0:s}: Wrong number of K-POINT blocks in {1:s}'.format(fname,section))
+    blocks = dict([(section,blocks[section]) for section in sections])
+
+    nchunks   = min(nkpnts,4*nproc)
+    ik_bounds = np.linspace(0,nkpnts,nchunks+1).astype(int)
+    ik_ranges = [(ik_bounds[i],ik_bounds[i+1]) for i in range(nchunks) if ik_bounds[i+1] > ik_bounds[i]]
+
+    shared_dir = utils.create_shared_dir_1(prefix='atomic_proj_')
+    try:
+        out_files  = {}
+        for key in out:
+            dtype,shape = out[key]
+            out_files[key] = utils.create_shared_array_1(shared_dir,key,shape,dtype)
+
+        print('{0:s}: Parsing {1:d} k-ranges with {2:d} worker processes'.format(fname,len(ik_ranges),nproc))
+        with utils.profile_step('parse atomic_proj.xml (workers)'):
+            pool = multiprocessing.Pool(processes = nproc)
+            try:
+                partial_read = partial(read_atomic_proj_kblock_1,atomic_proj=atomic_proj,blocks=blocks,
+                                       out_files=out_files,Efermi=proj['Efermi'],nawf=nawf)
+                utils.add_profile_workers_1(pool.map(partial_read,ik_ranges))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        for key in out_files:
+            proj[key] = np.array(utils.attach_shared_array_1(out_files[key],mode='r'))
+    finally:
+        utils.remove_shared_dir_1(shared_dir)
+
+    return proj
 def read_QE_data_file_xml_v2(data_file,data_file_out=''):
     fname = utils.fname() 
    
@@ -477,28 +1760,22 @@ def read_QE_data_file_xml_v2(data_file,data_file_out=''):
    
    
     a_vectors_units  = root.findall("./CELL/DIRECT_LATTICE_VECTORS/UNITS_FOR_DIRECT_LATTICE_VECTORS")[0].attrib['UNITS']
-    aux=root.findall("./CELL/DIRECT_LATTICE_VECTORS/a1")[0].text.split()
-    a1=[float(i) for i in aux]
+    a1=utils.xml_text2array(root.findall("./CELL/DIRECT_LATTICE_VECTORS/a1")[0].text)
    
-    aux=root.findall("./CELL/DIRECT_LATTICE_VECTORS/a2")[0].text.split()
-    a2=[float(i) for i in aux]
+    a2=utils.xml_text2array(root.findall("./CELL/DIRECT_LATTICE_VECTORS/a2")[0].text)
    
-    aux=root.findall("./CELL/DIRECT_LATTICE_VECTORS/a3")[0].text.split()
-    a3=[float(i) for i in aux]
+    a3=utils.xml_text2array(root.findall("./CELL/DIRECT_LATTICE_VECTORS/a3")[0].text)
    
     a_vectors = np.array([a1,a2,a3]) #in Bohrs
     print('{0:s}: Direct lattice vectors ({1:s}):'.format(fname,a_vectors_units))
     print(a_vectors)
    
     b_vectors_units   =root.findall("./CELL/RECIPROCAL_LATTICE_VECTORS/UNITS_FOR_RECIPROCAL_LATTICE_VECTORS")[0]
-    aux=root.findall("./CELL/RECIPROCAL_LATTICE_VECTORS/b1")[0].text.split()
-    b1=[float(i) for i in aux]
+    b1=utils.xml_text2array(root.findall("./CELL/RECIPROCAL_LATTICE_VECTORS/b1")[0].text)
    
-    aux=root.findall("./CELL/RECIPROCAL_LATTICE_VECTORS/b2")[0].text.split()
-    b2=[float(i) for i in aux]
+    b2=utils.xml_text2array(root.findall("./CELL/RECIPROCAL_LATTICE_VECTORS/b2")[0].text)
    
-    aux=root.findall("./CELL/RECIPROCAL_LATTICE_VECTORS/b3")[0].text.split()
-    b3=[float(i) for i in aux]
+    b3=utils.xml_text2array(root.findall("./CELL/RECIPROCAL_LATTICE_VECTORS/b3")[0].text)
    
     b_vectors = np.array([b1,b2,b3]) #in Bohrs
    
@@ -520,7 +1797,7 @@ def read_QE_data_file_xml_v2(data_file,data_file_out=''):
     for ik in range(nkpnts):
         weights[ik] = float(root.findall("./BRILLOUIN_ZONE/K-POINT.{0:d}".format(ik+1))[0].attrib['WEIGHT'])
         aux         = root.findall("./BRILLOUIN_ZONE/K-POINT.{0:d}".format(ik+1))[0].attrib['XYZ']
-        kpnts[ik,:] = np.array([float(i) for i in aux.split()])
+        kpnts[ik,:] = utils.xml_text2array(aux)
   
     nsym     = int(root.findall("./SYMMETRIES/NUMBER_OF_SYMMETRIES")[0].text.split()[0])
     nrot     = int(root.findall("./SYMMETRIES/NUMBER_OF_BRAVAIS_SYMMETRIES")[0].text.split()[0])
@@ -533,13 +1810,19 @@ def read_QE_data_file_xml_v2(data_file,data_file_out=''):
     units_for_symmetries = root.findall("./SYMMETRIES/UNITS_FOR_SYMMETRIES")[0].attrib['UNITS']
     aux      = root.findall("./SYMMETRIES/NO_TIME_REV_OPERATIONS")[0].text.split()[0]
     no_t_rev = aux in ['T'] #QE input
-    symop    = np.zeros((nrot,3,3), dtype=np.int)
+    symop    = np.zeros((nrot,3,3), dtype=int)
 
     units_for_symmetries = root.findall("./SYMMETRIES/UNITS_FOR_SYMMETRIES")[0].attrib['UNITS']
 
     for irot in range(nrot):
         aux = root.findall("./SYMMETRIES/SYMM.{0:d}/ROTATION".format(irot+1))[0].text
-        symop[irot, ... ] = np.transpose(np.reshape(np.fromstring(aux,dtype='int',sep='\n'),(3,3)))
+        symop[irot, ... ] = np.transpose(utils.xml_text2array(aux,'integer',shape=(3,3)))
+
+    ftau     = np.zeros((nrot,3)) #crystal coordinates
+    for irot in range(nrot):
+        aux = root.findall("./SYMMETRIES/SYMM.{0:d}/FRACTIONAL_TRANSLATION".format(irot+1))
+        if aux:
+            ftau[irot,:] = utils.xml_text2array(aux[0].text)
 
     natoms  = int(root.findall("./IONS/NUMBER_OF_ATOMS")[0].text.split()[0])
     ntype   = int(root.findall("./IONS/NUMBER_OF_SPECIES")[0].text.split()[0])
@@ -562,7 +1845,7 @@ def read_QE_data_file_xml_v2(data_file,data_file_out=''):
         flabel= "./IONS/ATOM.{0:d}".format(i+1)
         atoms_species[i]= root.findall(flabel)[0].attrib['SPECIES'].split()[0]
         atoms_index[i]  = int(root.findall(flabel)[0].attrib['INDEX'])
-        atoms_coords[i,:]  = np.array(map(float,root.findall(flabel)[0].attrib['tau'].split()))
+        atoms_coords[i,:]  = utils.xml_text2array(root.findall(flabel)[0].attrib['tau'])
    
    
     nr1 = int(root.findall("./PLANE_WAVES/FFT_GRID")[0].attrib['nr1'])
@@ -589,7 +1872,8 @@ def read_QE_data_file_xml_v2(data_file,data_file_out=''):
                  nr1=nr1, nr2=nr2, nr3=nr3,\
                  Efermi=Efermi, Efermi_units=Efermi_units,\
                  nbnds=nbnds,nkpnts=nkpnts,kpnts_wght=weights,nspin=nspin,\
-                 nrot=nrot, nsym=nsym, invsym=invsym, symop=symop) #sym
+                 nrot=nrot, nsym=nsym, invsym=invsym, symop=symop, ftau=ftau,\
+                 time_reversal=time_reversal) #sym
    
     return  {'alat_units':alat_units,\
              'alat':alat,\
@@ -608,9 +1892,15 @@ def read_QE_data_file_xml_v2(data_file,data_file_out=''):
              'nr1':nr1, 'nr2':nr2, 'nr3':nr3,\
              'Efermi':Efermi, 'Efermi_units':Efermi_units,\
              'nbnds':nbnds, 'nkpnts':nkpnts, 'kpnts_wght':weights, 'nspin':nspin,\
-             'nrot':nrot, 'nsym':nsym, 'invsym':invsym, 'symop':symop} #sym
-def read_QE_output_xml_v4(data_file,QE_xml_data_file,atomic_proj='',read_eigs=True, read_U=False, read_S=False, nproc=1):
-    
+             'nrot':nrot, 'nsym':nsym, 'invsym':invsym, 'symop':symop, 'ftau':ftau,\
+             'time_reversal':time_reversal} #sym
+@utils.profile_stage('read_QE_output_xml_v4')
+def read_QE_output_xml_v4(data_file,QE_xml_data_file,atomic_proj='',read_eigs=True, read_U=False, read_S=False, nproc=1,
+                          use_cache=True):
+    """
+    use_cache: skip the parsing if QE_xml_data_file was built from the same
+               xml files and read_* options (see utils.check_stage_cache_1).
+    """
 
     fname = utils.fname() 
    
@@ -631,16 +1921,34 @@ def read_QE_output_xml_v4(data_file,QE_xml_data_file,atomic_proj='',read_eigs=Tr
         print('{0:s}: Ouput directory {1:s} does not exist.'
               ' Attempting to create it.'.format(fname,QE_xml_data_dir))
         os.makedirs(QE_xml_data_dir)
+
+    stage_inputs = [data_file,atomic_proj] if read_atomic_proj else [data_file]
+    stage_params = {'read_eigs':read_eigs,'read_U':read_U,'read_S':read_S}
+    stage_digest = utils.stage_hash_1(fname,stage_inputs,stage_params)
+    if utils.check_stage_cache_1(fname,QE_xml_data_file,stage_digest,use_cache=use_cache):
+        if not read_atomic_proj:
+            return
+        aux = utils.load_data_1(QE_xml_data_file)
+        return tuple([aux[key] for key in ['U','Sk','eigsmat','alat_units','alat','a_vectors_units',
+                      'a_vectors','nkpnts','nspin','kpnts','kpnts_wght','nbnds','Efermi',
+                      'Efermi_units','nawf','nrot','nsym','invsym','symop']])
    
-    aux         = read_QE_data_file_xml_v2(data_file)
+    with utils.profile_step('parse data-file.xml'):
+        aux     = read_QE_data_file_xml_v2(data_file)
     alat_units  = aux['alat_units']
     alat        = aux['alat']
     a_vectors_units   = aux['a_vectors_units']
     a_vectors   = aux['a_vectors']
+    atoms_species = aux['atoms_species']
+    atoms_coords  = aux['atoms_coords']
+    if aux['atoms_units'].lower() == 'alat':
+        atoms_coords = atoms_coords*alat #in Bohrs
     nrot        = aux['nrot']   #sym
     nsym        = aux['nsym']   
     invsym      = aux['invsym'] 
     symop       = aux['symop'] 
+    ftau        = aux['ftau']
+    time_reversal = aux['time_reversal']
 
     if not read_atomic_proj: 
         kpnts      = aux['kpnts']
@@ -651,239 +1959,59 @@ def read_QE_output_xml_v4(data_file,QE_xml_data_file,atomic_proj='',read_eigs=Tr
         Efermi     = float(aux['Efermi'])
         Efermi_units= aux['Efermi_units']
         nawf       = 0
-        np.savez(QE_xml_data_file, nawf=nawf, \
+        utils.save_data_1(QE_xml_data_file, nawf=nawf, \
                  alat_units=alat_units, alat=alat, a_vectors_units=a_vectors_units, a_vectors=a_vectors, \
                  nkpnts=nkpnts, nspin=nspin, kpnts=kpnts, kpnts_wght=kpnts_wght, \
                  nbnds=nbnds, Efermi=Efermi, Efermi_units=Efermi_units,\
-                 nrot=nrot, nsym=nsym, invsym=invsym, symop=symop)
+                 atoms_species=atoms_species, atoms_coords=atoms_coords,\
+                 nrot=nrot, nsym=nsym, invsym=invsym, symop=symop, ftau=ftau,\
+                 time_reversal=time_reversal)
+        utils.save_stage_hash_1(fname,QE_xml_data_file,stage_digest,stage_inputs,stage_params)
         return
 
 
     print('Reading atomic_proj.xml ...')
-    tree  = ET.parse(atomic_proj)
-    root  = tree.getroot()
-   
-    nkpnts = int(root.findall("./HEADER/NUMBER_OF_K-POINTS")[0].text.strip())
-    print('Number of kpoints: {0:d}'.format(nkpnts))
-   
-    nspin  = int(root.findall("./HEADER/NUMBER_OF_SPIN_COMPONENTS")[0].text.split()[0])
-    print('Number of spin components: {0:d}'.format(nspin))
-   
-    kunits = root.findall("./HEADER/UNITS_FOR_K-POINTS")[0].attrib['UNITS']
-    print('Units for the kpoints: {0:s}'.format(kunits))
-   
-    aux = root.findall("./K-POINTS")[0].text.split()
-    kpnts  = np.array([float(i) for i in aux]).reshape((nkpnts,3))
-    print('Read the kpoints')
-   
-    aux = root.findall("./WEIGHT_OF_K-POINTS")[0].text.split()
-    kpnts_wght  = np.array([float(i) for i in aux])
-   
-    if kpnts_wght.shape[0] != nkpnts:
-    	sys.exit('Error in size of the kpnts_wght vector')
+    utils.set_profile_info_1(nproc=nproc,read_eigs=read_eigs,read_U=read_U,read_S=read_S)
+    if nproc == 1:
+        with utils.profile_step('parse atomic_proj.xml'):
+            proj = read_atomic_proj_xml_stream_1(atomic_proj,read_eigs=read_eigs,read_U=read_U,read_S=read_S)
+    elif nproc > 1:
+        proj = read_atomic_proj_xml_par_1(atomic_proj,read_eigs=read_eigs,read_U=read_U,read_S=read_S,nproc=nproc)
     else:
-    	print('Read the weight of the kpoints')
-   
-   
-    nbnds  = int(root.findall("./HEADER/NUMBER_OF_BANDS")[0].text.split()[0])
-    print('Number of bands: {0:d}'.format(nbnds))
-   
-    Efermi_units    = root.findall("./HEADER/UNITS_FOR_ENERGY")[0].attrib['UNITS']
-   
-    if Efermi_units=='Rydberg':
-       Efermi_units='eV'
-    else:
-       sys.error('Energy units has to be in Rydbers')
-   
-    Efermi = float(root.findall("./HEADER/FERMI_ENERGY")[0].text.split()[0])*Ry2eV
-   
-    print('Fermi energy: {0:f} (eV)'.format(Efermi))
-   
-    nawf   =int(root.findall("./HEADER/NUMBER_OF_ATOMIC_WFC")[0].text.split()[0])
-    print('Number of atomic wavefunctions: {0:d}'.format(nawf))
-   
-    U=None
-    Sks=None
-    my_eigsmat = None
-   
-    if read_eigs: 
-       print('Reading eigenvalues with {0:d} processors'.format(nproc))
-       my_eigsmat = np.zeros((nbnds,nkpnts,nspin))
-       if nproc > 1:
-          parallel   = True
-       elif nproc == 1:
-          parallel   = False
-       else:
-           sys.exit('Wrong number of processors')
-   
-   
-       if parallel == True:
-           for ispin in range(nspin):
-               tic = time.time()
-               my_eigsmat_list=read_eigenvalues_xml_par(nkpnts,Efermi,nspin,ispin,root,nproc)
-   
-               toc = time.time()
-               hours, rem = divmod(toc-tic, 3600)
-               minutes, seconds = divmod(rem, 60)
-               print("Parallel parsing of eigenvalues[k] {:0>2}:{:0>2}:{:05.2f}".format(int(hours),int(minutes),seconds))
-   
-               tic = time.time()
-               for ik in range(nkpnts):
-                   my_eigsmat[:,ik,ispin]=my_eigsmat_list[ik]
-               toc = time.time()
-               hours, rem = divmod(toc-tic, 3600)
-               minutes, seconds = divmod(rem, 60)
-               print("Converting eigevalues[k] from lists to matrix {:0>2}:{:0>2}:{:05.2f}".format(int(hours),int(minutes),seconds))
-   
-   
-       else:
-           for ispin in range(nspin):
-             for ik in range(nkpnts):
-               if nspin==1:
-                   eigk_type=root.findall("./EIGENVALUES/K-POINT.{0:d}/EIG".format(ik+1))[0].attrib['type']
-               else:
-                   eigk_type=root.findall("./EIGENVALUES/K-POINT.{0:d}/EIG.{1:d}".format(ik+1,ispin+1))[0].attrib['type']
-               if eigk_type != 'real':
-                 sys.exit('Reading eigenvalues that are not real numbers')
-               if nspin==1:
-                 eigk_file=np.array([float(i) for i in root.findall("./EIGENVALUES/K-POINT.{0:d}/EIG".format(ik+1))[0].text.split()])
-               else:
-                 eigk_file=np.array([float(i) for i in root.findall("./EIGENVALUES/K-POINT.{0:d}/EIG.{1:d}".format(ik+1,ispin+1))[0].text.split().split()])
-               my_eigsmat[:,ik,ispin] = np.real(eigk_file)*Ry2eV-Efermi #meigs in eVs and wrt Ef
-   
-   
+        sys.exit('Wrong number of processors')
+
+    nkpnts      = proj['nkpnts']
+    nspin       = proj['nspin']
+    kpnts       = proj['kpnts']
+    kpnts_wght  = proj['kpnts_wght']
+    nbnds       = proj['nbnds']
+    Efermi      = proj['Efermi']
+    Efermi_units= proj['Efermi_units']
+    nawf        = proj['nawf']
+    my_eigsmat  = proj['eigsmat']
+    U           = proj['U']
+    Sks         = proj['Sk']
+
     if read_U:
-       print('Reading projections with {0:d} processors'.format(nproc))
-       Uaux    = np.zeros((nbnds,nawf, nkpnts,nspin),dtype=complex)
-       U       = np.zeros((nawf, nbnds,nkpnts,nspin),dtype=complex)
-       if nproc > 1:
-          parallel   = True
-       elif nproc == 1:
-          parallel   = False
-       else:
-           sys.exit('Wrong number of processors')
-   
-       if parallel == True:
-           for ispin in range(nspin):
-               tic = time.time()
-               Uaux_list      =read_projections_xml_par(nkpnts,nawf,nbnds,nspin,ispin,root,nproc)
-               toc = time.time()
-               hours, rem = divmod(toc-tic, 3600)
-               minutes, seconds = divmod(rem, 60)
-               print("Parallel parsing of U[k] {:0>2}:{:0>2}:{:05.2f}".format(int(hours),int(minutes),seconds))
-   
-               tic = time.time()
-               for ik in range(nkpnts):
-                   U[:,:,ik,ispin] = Uaux_list[ik]
-               toc = time.time()
-               hours, rem = divmod(toc-tic, 3600)
-               minutes, seconds = divmod(rem, 60)
-               print("Converting U[k] from lists to matrix {:0>2}:{:0>2}:{:05.2f}".format(int(hours),int(minutes),seconds))
-   
-   
-       else:
-           for ispin in range(nspin):
-             for ik in range(nkpnts):
-               for iin in range(nawf): #There will be nawf projections. Each projector of size nbnds x 1
-                 if nspin==1:
-                   wfc_type=root.findall("./PROJECTIONS/K-POINT.{0:d}/ATMWFC.{1:d}".format(ik+1,iin+1))[0].attrib['type']
-                   aux     =root.findall("./PROJECTIONS/K-POINT.{0:d}/ATMWFC.{1:d}".format(ik+1,iin+1))[0].text
-                 else:
-                   wfc_type=root.findall("./PROJECTIONS/K-POINT.{0:d}/SPIN.{1:d}/ATMWFC.{2:d}".format(ik+1,iin+1))[0].attrib['type']
-                   aux     =root.findall("./PROJECTIONS/K-POINT.{0:d}/SPIN.{1:d}/ATMWFC.{2:d}".format(ik+1,ispin+1,iin+1))[0].text
-   
-                 aux = np.array([float(i) for i in re.split(',|\n',aux.strip())])
-   
-                 if wfc_type=='real':
-                   wfc = aux.reshape((nbnds,1))#wfc = nbnds x 1
-                   Uaux[:,iin,ik,ispin] = wfc[:,0]
-                 elif wfc_type=='complex':
-                   wfc = aux.reshape((nbnds,2))
-                   Uaux[:,iin,ik,ispin] = wfc[:,0]+1j*wfc[:,1]
-                 else:
-                   sys.exit('neither real nor complex??')
-   
-           for ispin in range(nspin):
-             for ik in range(nkpnts):
-               U[:,:,ik,ispin] = np.transpose(Uaux[:,:,ik,ispin]) #transpose of U. Now the columns of UU are the eigenvector of length nawf
-   
        test = np.isnan(U)
        if True in test:
          sys.exit('Found a NaN projection coefficient. Crashing ...')
-   
-    if read_S:
-        print('Reading overlap matrix')
-        Sks  = np.zeros((nawf,nawf,nkpnts),dtype=complex)
-        if parallel == True:
-           tic = time.time()
-           Sks_list = read_overlap_xml_par(nkpnts,nawf,root,nproc)
-           toc = time.time()
-           hours, rem = divmod(toc-tic, 3600)
-           minutes, seconds = divmod(rem, 60)
-           print("Parallel parsing of S[k] {:0>2}:{:0>2}:{:05.2f}".format(int(hours),int(minutes),seconds))
-   
-           tic = time.time()
-           for ik in range(nkpnts):
-               Sks[:,:,ik] = Sks_list[ik]
-           toc = time.time()
-           hours, rem = divmod(toc-tic, 3600)
-           minutes, seconds = divmod(rem, 60)
-           print("Converting S[k] list to matrix {:0>2}:{:0>2}:{:05.2f}".format(int(hours),int(minutes),seconds))
-        else:
-           for ik in range(nkpnts):
-             ovlp_type = root.findall("./OVERLAPS/K-POINT.{0:d}/OVERLAP.1".format(ik+1))[0].attrib['type']
-             aux = root.findall("./OVERLAPS/K-POINT.{0:d}/OVERLAP.1".format(ik+1))[0].text
-             aux = np.array([float(i) for i in re.split(',|\n',aux.strip())])
-   
-             if ovlp_type !='complex':
-               sys.exit('the overlaps are assumed to be complex numbers')
-             if len(aux) != nawf**2*2:
-               sys.exit('wrong number of elements when reading the S matrix')
-   
-             aux = aux.reshape((nawf**2,2))
-             ovlp_vector = aux[:,0]+1j*aux[:,1]
-             Sks_aux  = ovlp_vector.reshape((nawf,nawf),order='F')
-             Sks[:,:,ik] = np.triu(Sks_aux,1)+np.diag(np.diag(Sks_aux))+np.conj(np.triu(Sks_aux,1)).T
   
-    np.savez(QE_xml_data_file, \
-             U=U, Sk=Sks, eigsmat=my_eigsmat, alat_units=alat_units, alat=alat, a_vectors_units=a_vectors_units, a_vectors=a_vectors, \
-             nkpnts=nkpnts, nspin=nspin, kpnts=kpnts, kpnts_wght=kpnts_wght, \
-             nbnds=nbnds, Efermi=Efermi, Efermi_units=Efermi_units, nawf=nawf, \
-             nrot=nrot, nsym=nsym, invsym=invsym, symop=symop) #sym
+    with utils.profile_step('write'):
+        utils.save_data_1(QE_xml_data_file, \
+                 U=U, Sk=Sks, eigsmat=my_eigsmat, alat_units=alat_units, alat=alat, a_vectors_units=a_vectors_units, a_vectors=a_vectors, \
+                 nkpnts=nkpnts, nspin=nspin, kpnts=kpnts, kpnts_wght=kpnts_wght, \
+                 nbnds=nbnds, Efermi=Efermi, Efermi_units=Efermi_units, nawf=nawf, \
+                 atoms_species=atoms_species, atoms_coords=atoms_coords, \
+                 nrot=nrot, nsym=nsym, invsym=invsym, symop=symop, ftau=ftau, \
+                 time_reversal=time_reversal) #sym
+    utils.save_stage_hash_1(fname,QE_xml_data_file,stage_digest,stage_inputs,stage_params)
     return(U,Sks, my_eigsmat, alat_units, alat, a_vectors_units, a_vectors, nkpnts, nspin,\
         kpnts, kpnts_wght, nbnds, Efermi, Efermi_units,nawf, \
         nrot, nsym, invsym, symop) #sym
 def plot_compare_TB_DFT_eigs(Hks,my_eigsmat):
-    import matplotlib.pyplot as plt
-    import os
-
-    nawf,nawf,nkpnts,nspin = Hks.shape
-    nbnds_tb = nawf
-    E_k = np.zeros((nbnds_tb,nkpnts,nspin))
-
-    ispin = 0 #plots only 1 spin channel
-    for ik in range(nkpnts):
-        eigval,_ = la.eig(Hks[:,:,ik,ispin])
-        E_k[:,ik,ispin] = np.sort(np.real(eigval))
-
-    fig=plt.figure
-    nbnds_dft,_,_=my_eigsmat.shape
-    for i in range(nbnds_dft):
-        yy = my_eigsmat[i,:,ispin]
-        if i==0:
-          plt.plot(yy,'-',linewidth=3,color='lime',label='DFT')
-        else:
-          plt.plot(yy,'-',linewidth=3,color='lime')
-
-    for i in range(nbnds_tb):
-        yy = E_k[i,:,ispin]
-        if i==0:
-          plt.plot(yy,'ok',markersize=2,markeredgecolor='None',label='TB')
-        else:
-          plt.plot(yy,'ok',markersize=2,markeredgecolor='None')
-
-    plt.xlabel('k-points')
-    plt.ylabel('Energy - E$_F$ (eV)')
-    plt.legend()
-    plt.title('Comparison of TB vs. DFT eigenvalues')
-    plt.savefig('comparison.pdf',format='pdf')
+    """
+    Figure comparing the eigenvalues of Hks with the DFT ones (see lib_plot)
+    """
+    import lib_plot
+    lib_plot.plot_compare_TB_DFT_eigs(Hks,my_eigsmat)
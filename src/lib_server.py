@@ -0,0 +1,237 @@
+"""
+Local band-query server. A long-running process keeps the H(R) models
+(lib_pytb.TBModel) of recently used HR files in an LRU cache and answers
+batched k-point queries sent as one JSON object per line over a Unix socket
+(address = path) or a localhost TCP port (address = (host,port)).
+
+query:    {"id": any, "HR_file": path, "kpts": [[k1,k2,k3],...],
+           "units": "crystal"|"cartesian", "eigvec": false, "velocity": false}
+response: {"id": any, "ok": true, "Ek": [nk][nspin][nawf], "vk": ...,
+           "vec_re"/"vec_im": ..., "nbad": int, "time": seconds}
+          or {"id": any, "ok": false, "error": message}; a line that is not
+          a JSON object is answered with "id": null and the connection is closed
+control:  {"cmd": "stats"} and {"cmd": "shutdown"}
+
+The diagonalizations run on a pool of worker threads (numpy's LAPACK calls
+release the GIL), so replies to the queries of one connection may come out
+of order; "id" is echoed back. The asyncio front end needs Python 3.
+"""
+from __future__ import print_function
+from __future__ import division
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import lib_utils as utils
+
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    asyncio = None
+
+class ModelCache(object):
+    """
+    Thread-safe LRU cache of TBModel objects keyed by (HR file path, mtime);
+    a model whose file changed on disk is reloaded.
+    """
+    def __init__(self,max_models=4):
+        self.max_models = max_models
+        self.models     = OrderedDict()
+        self.lock       = threading.Lock()
+        self.loading    = {}
+        self.hits       = 0
+        self.misses     = 0
+    def get(self,HR_file):
+        import lib_pytb
+        path = os.path.abspath(HR_file)
+        key  = (path,os.path.getmtime(path))
+        with self.lock:
+            model = self.models.pop(key,None)
+            if model is not None:
+                self.hits += 1
+                self.models[key] = model
+                return model
+            path_lock = self.loading.setdefault(path,threading.Lock())
+        #concurrent queries of the same file wait for a single load
+        with path_lock:
+            with self.lock:
+                model = self.models.pop(key,None)
+                if model is not None:
+                    self.hits += 1
+                    self.models[key] = model
+                    return model
+                self.misses += 1
+            model = lib_pytb.TBModel(path)
+            with self.lock:
+                for old in [aux for aux in self.models if aux[0] == path]:
+                    del self.models[old]
+                self.models[key] = model
+                while len(self.models) > self.max_models:
+                    self.models.popitem(last=False)
+        return model
+    def stats(self):
+        with self.lock:
+            return {'models':[aux[0] for aux in self.models],'hits':self.hits,'misses':self.misses,
+                    'max_models':self.max_models}
+def handle_query_1(cache,query):
+    """
+    Answers one band query (a dictionary, see the module docstring) with the
+    models of cache; errors are returned in the response, not raised.
+    """
+    tic = time.time()
+    response = {'id':query.get('id')}
+    try:
+        model = cache.get(query['HR_file'])
+        eigvec   = bool(query.get('eigvec',False))
+        velocity = bool(query.get('velocity',False))
+        Ek,vec,vk,report = model.eig(query['kpts'],units=query.get('units','crystal'),
+                                     eigvec=eigvec,velocity=velocity)
+        response.update({'ok':True,'Ek':Ek.tolist(),'nbad':int(sum(~report['positive']))})
+        if eigvec:
+            response['vec_re'] = vec.real.tolist()
+            response['vec_im'] = vec.imag.tolist()
+        if velocity:
+            response['vk'] = vk.tolist()
+    except (Exception,SystemExit) as error:
+        response.update({'ok':False,'error':'{0:s}: {1:s}'.format(type(error).__name__,str(error))})
+    response['time'] = time.time()-tic
+    return response
+if asyncio is not None:
+    class BandQueryProtocol(asyncio.Protocol):
+        """
+        Reads JSON lines from a connection; queries go to the worker pool
+        and control commands are answered on the event loop.
+        """
+        def __init__(self,state):
+            self.state  = state
+            self.buffer = b''
+        def connection_made(self,transport):
+            self.transport = transport
+        def data_received(self,data):
+            self.buffer += data
+            while b'\n' in self.buffer and not self.transport.is_closing():
+                line,self.buffer = self.buffer.split(b'\n',1)
+                if line.strip():
+                    self.handle_line(line)
+        def reply(self,response):
+            if not self.transport.is_closing():
+                self.transport.write(json.dumps(response).encode('utf-8')+b'\n')
+        def handle_line(self,line):
+            try:
+                query = json.loads(line.decode('utf-8'))
+                if not isinstance(query,dict):
+                    raise ValueError('a query must be a JSON object')
+            except ValueError as error:
+                #the id of the query is unknown: the client is told and disconnected
+                self.reply({'id':None,'ok':False,'error':'ValueError: {0!s}'.format(error)})
+                self.transport.close()
+                return
+            try:
+                self.dispatch(query)
+            except Exception as error:
+                self.reply({'id':query.get('id'),'ok':False,
+                            'error':'{0:s}: {1!s}'.format(type(error).__name__,error)})
+        def dispatch(self,query):
+            cmd = query.get('cmd','eig')
+            if cmd == 'stats':
+                self.reply(dict(self.state['cache'].stats(),id=query.get('id'),ok=True))
+            elif cmd == 'shutdown':
+                self.reply({'id':query.get('id'),'ok':True})
+                if not self.state['stop'].done():
+                    self.state['stop'].set_result(True)
+            elif cmd == 'eig':
+                future = self.state['loop'].run_in_executor(self.state['executor'],handle_query_1,
+                                                            self.state['cache'],query)
+                future.add_done_callback(lambda aux: self.reply(aux.result()))
+            else:
+                self.reply({'id':query.get('id'),'ok':False,'error':'unknown cmd {0!s}'.format(cmd)})
+def serve_bands_1(address,max_models=4,nworkers=4,preload=[]):
+    """
+    Runs the band-query server on address (Unix socket path, or (host,port)
+    for TCP on localhost) until a {"cmd": "shutdown"} request.
+    max_models: size of the LRU model cache
+    nworkers:   number of worker threads for the diagonalizations
+    preload:    HR files loaded into the cache before serving
+    """
+    fname = utils.fname()
+    if asyncio is None:
+        sys.exit('{0:s}: the asyncio front end needs Python 3'.format(fname))
+
+    cache = ModelCache(max_models)
+    for HR_file in preload:
+        cache.get(HR_file)
+
+    loop  = asyncio.new_event_loop()
+    state = {'cache':cache,'loop':loop,'executor':ThreadPoolExecutor(max_workers=nworkers),
+             'stop':loop.create_future()}
+    if isinstance(address,str):
+        if os.path.exists(address):
+            os.remove(address)
+        server = loop.run_until_complete(loop.create_unix_server(lambda: BandQueryProtocol(state),address))
+    else:
+        server = loop.run_until_complete(loop.create_server(lambda: BandQueryProtocol(state),
+                                                            address[0],address[1]))
+    print('{0:s}: Serving band queries on {1:s} with {2:d} workers'.format(fname,str(address),nworkers))
+    try:
+        loop.run_until_complete(state['stop'])
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        state['executor'].shutdown()
+        loop.close()
+        if isinstance(address,str) and os.path.exists(address):
+            os.remove(address)
+    print('{0:s}: Server stopped, {1:d} cache hits, {2:d} misses'.format(fname,cache.hits,cache.misses))
+def query_bands_1(address,queries,timeout=60.0):
+    """
+    Blocking client: sends the queries (dictionaries) to the server at
+    address and returns the responses in the order of the queries.
+    On the wire every query carries its position as id, so the replies
+    (which may come out of order) are matched by position; the "id" of
+    each query, if any, is put back in its response.
+    timeout: seconds without data from the server before socket.timeout is
+             raised (None waits forever). If the server closes the connection
+             (after a malformed line), the missing responses are the
+             server's error response, or None.
+    address=None is the in-process stand-in: the queries are answered by
+    handle_query_1 with a module-level ModelCache, without a server.
+    """
+    if address is None:
+        return [handle_query_1(local_cache,query) for query in queries]
+
+    if isinstance(address,str):
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(address)
+    for i,query in enumerate(queries):
+        query = dict(query,id=i)
+        sock.sendall(json.dumps(query).encode('utf-8')+b'\n')
+
+    responses = {}
+    buffer    = b''
+    while len(responses) < len(queries):
+        data = sock.recv(1 << 20)
+        if not data:
+            break
+        buffer += data
+        while b'\n' in buffer:
+            line,buffer = buffer.split(b'\n',1)
+            response = json.loads(line.decode('utf-8'))
+            responses[response.get('id')] = response
+    sock.close()
+
+    out = []
+    for i,query in enumerate(queries):
+        response = responses.get(i,responses.get(None))
+        if response is not None:
+            response = dict(response,id=i if query.get('id') is None else query['id'])
+        out.append(response)
+    return out
+local_cache = ModelCache()
@@ -6,6 +6,16 @@ import multiprocessing
 import signal
 import time
 import datetime
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+import functools
+try:
+    import resource
+except ImportError:
+    resource = None
 
 from scipy import linalg as sla
 from numpy import linalg as  la
@@ -31,3 +41,399 @@ def linspace_vector(v1,v2,ndivs):
     return np.hstack((lx,ly,lz))
 def fname():
     return  sys._getframe(1).f_code.co_name
+def xml_text2array(text,data_type='real',shape=None,order='C'):
+    """
+    Decodes a numeric text block (or attribute) written by QE/iotk into a
+    NumPy array in one call to the C parser of np.fromstring.
+    Values may be separated by blanks, newlines or commas.
+    data_type: 'real', 'integer', or 'complex' (consecutive re,im pairs)
+    shape,order: optional reshape of the decoded array
+    """
+    if data_type == 'integer':
+        aux = np.fromstring(text,dtype=int,sep=' ')
+    elif data_type in ['real','complex']:
+        aux = np.fromstring(text.replace(',',' '),dtype=float,sep=' ')
+        if data_type == 'complex':
+            if aux.size % 2 != 0:
+                sys.exit('xml_text2array: odd number of values in a complex block')
+            aux = aux.view(complex)
+    else:
+        sys.exit('xml_text2array: data_type {0:s} not recognized'.format(data_type))
+    if shape is not None:
+        aux = aux.reshape(shape,order=order)
+    return aux
+def save_data_1(data_path,compress=False,**arrays):
+    """
+    Saves the arrays of a pipeline stage (QE xml data, H(k), H(R)).
+    data_path ending in .npz: a single np.savez archive, or
+                              np.savez_compressed if compress
+    otherwise:                a directory data_path with one .npy file per
+                              array, which load_data_1 memory-maps so that
+                              only the slices actually used are read
+    """
+    if data_path.endswith('.npz'):
+        if compress:
+            np.savez_compressed(data_path,**arrays)
+        else:
+            np.savez(data_path,**arrays)
+        return
+
+    if compress:
+        print('save_data_1: compression is only available for .npz files')
+    if not os.path.isdir(data_path):
+        os.makedirs(data_path)
+    for aux in os.listdir(data_path):
+        if aux.endswith('.npy'):
+            os.remove(os.path.join(data_path,aux))
+    for key in arrays:
+        np.save(os.path.join(data_path,key+'.npy'),np.asanyarray(arrays[key]))
+def load_data_1(data_path,mmap_mode='r'):
+    """
+    Loads the arrays saved by save_data_1 (or any .npz archive).
+    For a .npy directory every array is memory-mapped with mmap_mode
+    (arrays of Python objects, e.g. None, are read normally).
+    returns a dictionary-like object {name: array}
+    """
+    if not os.path.isdir(data_path):
+        return np.load(data_path,allow_pickle=True)
+
+    data = {}
+    for aux in os.listdir(data_path):
+        if not aux.endswith('.npy'):
+            continue
+        try:
+            data[aux[:-4]] = np.load(os.path.join(data_path,aux),mmap_mode=mmap_mode)
+        except ValueError:
+            data[aux[:-4]] = np.load(os.path.join(data_path,aux),allow_pickle=True)
+    return data
+def create_shared_dir_1(prefix='pytb_'):
+    """
+    Temporary directory for arrays shared between processes through
+    memory-mapped files; in /dev/shm (RAM) when available
+    """
+    shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    return tempfile.mkdtemp(prefix=prefix,dir=shm_dir)
+def create_shared_array_1(shared_dir,name,shape,dtype,data=None):
+    """
+    Creates a memory-mapped array in shared_dir, optionally filled with data.
+    returns the descriptor (filename,dtype,shape) that worker processes pass
+    to attach_shared_array_1; only the descriptor is pickled.
+    """
+    desc = (os.path.join(shared_dir,name+'.dat'),np.dtype(dtype).str,tuple(shape))
+    aux  = np.memmap(desc[0],dtype=desc[1],mode='w+',shape=desc[2])
+    if data is not None:
+        aux[...] = data
+    aux.flush()
+    del aux
+    return desc
+def attach_shared_array_1(desc,mode='r+'):
+    """
+    Maps the shared array described by desc (see create_shared_array_1)
+    """
+    filename,dtype,shape = desc
+    return np.memmap(filename,dtype=dtype,mode=mode,shape=shape)
+def remove_shared_dir_1(shared_dir):
+    shutil.rmtree(shared_dir,ignore_errors=True)
+
+stage_cache_log = []
+hash_size_limit = 2**28   #bytes; larger input files are keyed by size and mtime
+
+def path_signature_1(path):
+    """
+    [name,size,mtime] of a file, or of every file of a directory (sorted)
+    """
+    if os.path.isdir(path):
+        files = sorted(os.listdir(path))
+        return [[f,os.path.getsize(os.path.join(path,f)),os.path.getmtime(os.path.join(path,f))] for f in files]
+    return [[os.path.basename(path),os.path.getsize(path),os.path.getmtime(path)]]
+def hash_path_1(path,chunk_size=2**24):
+    """
+    sha1 of the contents of a file or directory. If path is the output of a
+    cached stage (see save_stage_hash_1) and has not changed since, the
+    recorded stage hash is used instead of reading the contents.
+    Inputs larger than hash_size_limit (e.g. a multi-GB atomic_proj.xml)
+    are not read: the hash is that of their absolute path, size and mtime.
+    """
+    hash_file = path.rstrip('/')+'.hash'
+    if os.path.isfile(hash_file):
+        with open(hash_file,'r') as fid:
+            record = json.load(fid)
+        if record['signature'] == json.loads(json.dumps(path_signature_1(path))):
+            return record['hash']
+
+    if os.path.isdir(path):
+        files = [os.path.join(path,f) for f in sorted(os.listdir(path))]
+    else:
+        files = [path]
+    sha1 = hashlib.sha1()
+    if sum([os.path.getsize(f) for f in files]) > hash_size_limit:
+        sha1.update(json.dumps([os.path.abspath(path),path_signature_1(path)]).encode('utf-8'))
+        return sha1.hexdigest()
+    for f in files:
+        sha1.update(os.path.basename(f).encode('utf-8'))
+        with open(f,'rb') as fid:
+            while True:
+                chunk = fid.read(chunk_size)
+                if not chunk:
+                    break
+                sha1.update(chunk)
+    return sha1.hexdigest()
+def stage_hash_1(stage,inputs,params):
+    """
+    Hash of a pipeline stage: its name, the contents of its input files
+    (hash_path_1) and its parameters (a dictionary).
+    """
+    sha1 = hashlib.sha1(stage.encode('utf-8'))
+    for path in inputs:
+        sha1.update(hash_path_1(path).encode('ascii'))
+    sha1.update(json.dumps(params,sort_keys=True,default=str).encode('utf-8'))
+    return sha1.hexdigest()
+def check_stage_cache_1(stage,output,digest,use_cache=True):
+    """
+    True if output exists and was produced from inputs/parameters with the
+    same stage hash. Hits and misses are printed and logged in stage_cache_log.
+    use_cache=False forces a miss.
+    """
+    hash_file = output.rstrip('/')+'.hash'
+    hit = False
+    if use_cache and os.path.exists(output) and os.path.isfile(hash_file):
+        with open(hash_file,'r') as fid:
+            record = json.load(fid)
+        hit = (record['hash'] == digest) and \
+              (record['signature'] == json.loads(json.dumps(path_signature_1(output))))
+    stage_cache_log.append({'stage':stage,'output':output,'hit':hit})
+    print('{0:s}: cache {1:s} for {2:s}'.format(stage,'hit' if hit else 'miss',output))
+    return hit
+def save_stage_hash_1(stage,output,digest,inputs,params):
+    """
+    Records the stage hash of output in output.hash
+    """
+    record = {'stage':stage,'hash':digest,'inputs':list(inputs),
+              'params':json.loads(json.dumps(params,sort_keys=True,default=str)),
+              'signature':path_signature_1(output)}
+    with open(output.rstrip('/')+'.hash','w') as fid:
+        json.dump(record,fid,indent=1,sort_keys=True)
+def invalidate_stage_cache_1(output):
+    """
+    Removes the recorded stage hash of output, so the stage is recomputed
+    """
+    hash_file = output.rstrip('/')+'.hash'
+    if os.path.isfile(hash_file):
+        os.remove(hash_file)
+def stage_cache_report_1():
+    """
+    Prints and returns the number of cache hits and misses per stage
+    """
+    report = {}
+    for entry in stage_cache_log:
+        aux = report.setdefault(entry['stage'],{'hits':0,'misses':0})
+        if entry['hit']:
+            aux['hits']   += 1
+        else:
+            aux['misses'] += 1
+    for stage in sorted(report):
+        print('{0:s}: {1:d} hits, {2:d} misses'.format(stage,report[stage]['hits'],report[stage]['misses']))
+    return report
+
+#Instrumentation of the pipeline stages: profile_stage records the wall time,
+#CPU time and peak RSS of a stage (and the load balance of its workers) and
+#sends one record to the sink; profile_step accumulates the time of a sub-step
+#(parse, decode, Fourier sum, diagonalize, ...) in the innermost open stage of
+#the thread. The sink is set with set_profile_sink_1 or with the environment
+#variable PYTB_PROFILE = quiet | log | json:<trace_file>
+profile_config = {'sink':'log','trace_file':''}
+profile_local  = threading.local()
+profile_lock   = threading.Lock()
+
+def set_profile_sink_1(sink='log',trace_file=''):
+    """
+    sink: 'quiet' = records are discarded
+          'log'   = one summary per stage on stdout
+          'json'  = one JSON record per stage (one per line) appended to trace_file
+    """
+    if sink not in ['quiet','log','json']:
+        sys.exit('set_profile_sink_1: Value of sink not recognized')
+    if sink == 'json' and not trace_file:
+        sys.exit('set_profile_sink_1: the json sink needs a trace_file')
+    profile_config['sink']       = sink
+    profile_config['trace_file'] = trace_file
+def get_peak_rss_mb_1(children=False):
+    """
+    High-water mark of the resident memory of the process (or of its
+    largest waited-for child process), in MB; 0 without the resource module
+    """
+    if resource is None:
+        return 0.0
+    scale = 1024.0**2 if sys.platform == 'darwin' else 1024.0
+    who   = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    return resource.getrusage(who).ru_maxrss/scale
+def get_cpu_time_1(children=True):
+    aux = os.times()
+    if children:
+        return aux[0]+aux[1]+aux[2]+aux[3]
+    return aux[0]+aux[1]
+def get_profile_stack_1():
+    if not hasattr(profile_local,'stack'):
+        profile_local.stack = []
+    return profile_local.stack
+def format_elapsed_1(seconds):
+    hours, rem = divmod(seconds, 3600)
+    minutes, seconds = divmod(rem, 60)
+    return '{0:02d}:{1:02d}:{2:05.2f}'.format(int(hours),int(minutes),seconds)
+class profile_stage(object):
+    """
+    Context manager (or decorator) around a stage of the pipeline:
+        with utils.profile_stage('build_Hk_5',nspin=nspin) as stage:
+            with utils.profile_step('S^1/2'):
+                ...
+            stage.add_workers(pool.map(worker,tasks))
+    The keyword arguments and stage.info go to the record. Stages opened
+    inside a stage of the same thread are nested (path 'outer/inner').
+    CPU time includes the waited-for child processes; peak_rss_mb is the
+    high-water mark of the process when the stage ends.
+    """
+    def __init__(self,name,**info):
+        self.name    = name
+        self.info    = info
+        self.steps   = {}
+        self.workers = []
+    def __call__(self,func):
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            with profile_stage(self.name,**self.info):
+                return func(*args,**kwargs)
+        return wrapper
+    def __enter__(self):
+        stack = get_profile_stack_1()
+        self.path = '/'.join([aux.name for aux in stack]+[self.name])
+        stack.append(self)
+        self.start = time.time()
+        self.cpu0  = get_cpu_time_1()
+        return self
+    def __exit__(self,exc_type,exc_value,traceback):
+        wall = time.time()-self.start
+        cpu  = get_cpu_time_1()-self.cpu0
+        get_profile_stack_1().pop()
+        record = {'stage':self.path,'start':self.start,'wall_s':wall,'cpu_s':cpu,
+                  'peak_rss_mb':get_peak_rss_mb_1(),
+                  'children_peak_rss_mb':get_peak_rss_mb_1(children=True),
+                  'pid':os.getpid(),'ok':exc_type is None,
+                  'info':json.loads(json.dumps(self.info,default=str))}
+        if self.steps:
+            record['steps'] = self.steps
+        if self.workers:
+            record['workers'] = self.workers
+            busy = [aux['wall_s'] for aux in self.workers]
+            record['load_imbalance'] = max(busy)/max(np.mean(busy),1e-12)
+        emit_profile_record_1(record)
+        return False
+    def add_step(self,name,wall,cpu):
+        step = self.steps.setdefault(name,{'wall_s':0.0,'cpu_s':0.0,'calls':0})
+        step['wall_s'] += wall
+        step['cpu_s']  += cpu
+        step['calls']  += 1
+    def add_workers(self,stats):
+        """
+        Adds the profile_worker.stats of the tasks of a pool; the tasks run
+        by the same worker (pid, thread) are summed up.
+        """
+        workers = {}
+        for aux in stats:
+            if not isinstance(aux,dict):
+                continue
+            key    = (aux['pid'],aux['thread'])
+            worker = workers.setdefault(key,{'pid':aux['pid'],'thread':aux['thread'],'tasks':0,
+                                             'wall_s':0.0,'cpu_s':0.0,'peak_rss_mb':0.0})
+            worker['tasks']  += 1
+            worker['wall_s'] += aux['wall_s']
+            if aux['cpu_s'] is not None:
+                worker['cpu_s'] += aux['cpu_s']
+            worker['peak_rss_mb'] = max(worker['peak_rss_mb'],aux['peak_rss_mb'])
+        self.workers += [workers[key] for key in sorted(workers)]
+class profile_step(object):
+    """
+    Context manager adding the wall and CPU time of a sub-step to the
+    innermost open profile_stage of the thread (nothing without one)
+    """
+    def __init__(self,name):
+        self.name = name
+    def __enter__(self):
+        stack = get_profile_stack_1()
+        self.stage = stack[-1] if stack else None
+        if self.stage is not None:
+            self.start = time.time()
+            self.cpu0  = get_cpu_time_1()
+        return self
+    def __exit__(self,exc_type,exc_value,traceback):
+        if self.stage is not None:
+            self.stage.add_step(self.name,time.time()-self.start,get_cpu_time_1()-self.cpu0)
+        return False
+class profile_worker(object):
+    """
+    Clock of one task of a process or thread pool; the worker returns
+    clock.stats() and the parent passes the results to
+    profile_stage.add_workers. The CPU time of a thread is only available
+    with time.thread_time (Python 3.7+); None otherwise.
+    """
+    def __init__(self,thread=False):
+        self.thread = thread
+        self.start  = time.time()
+        self.cpu0   = self.cpu_time()
+    def cpu_time(self):
+        if not self.thread:
+            return get_cpu_time_1(children=False)
+        if hasattr(time,'thread_time'):
+            return time.thread_time()
+        return None
+    def stats(self,**info):
+        cpu = self.cpu_time()
+        return dict(pid=os.getpid(),thread=threading.current_thread().name if self.thread else '',
+                    wall_s=time.time()-self.start,cpu_s=None if cpu is None else cpu-self.cpu0,
+                    peak_rss_mb=get_peak_rss_mb_1(),**info)
+def set_profile_info_1(**info):
+    """
+    Adds info to the record of the innermost open profile_stage of the thread
+    """
+    stack = get_profile_stack_1()
+    if stack:
+        stack[-1].info.update(info)
+def add_profile_workers_1(stats):
+    """
+    profile_stage.add_workers on the innermost open profile_stage of the thread
+    """
+    stack = get_profile_stack_1()
+    if stack:
+        stack[-1].add_workers(stats)
+def emit_profile_record_1(record):
+    sink = profile_config['sink']
+    if sink == 'quiet':
+        return
+    if sink == 'json':
+        with profile_lock:
+            with open(profile_config['trace_file'],'a') as fid:
+                fid.write(json.dumps(record,sort_keys=True)+'\n')
+        return
+    print('{0:s}: Elapsed time {1:s}, CPU {2:.2f} s, peak RSS {3:.1f} MB{4:s}'.format(
+          record['stage'],format_elapsed_1(record['wall_s']),record['cpu_s'],record['peak_rss_mb'],
+          '' if record['ok'] else ' (failed)'))
+    for name in sorted(record.get('steps',{}),key=lambda aux: -record['steps'][aux]['wall_s']):
+        step = record['steps'][name]
+        print('{0:s}:   {1:s} {2:.2f} s ({3:d} calls)'.format(record['stage'],name,step['wall_s'],step['calls']))
+    if 'workers' in record:
+        print('{0:s}:   {1:d} workers, load imbalance (max/mean busy time) {2:.2f}'.format(
+              record['stage'],len(record['workers']),record['load_imbalance']))
+def set_profile_sink_env_1(value):
+    """
+    Sets the sink from a PYTB_PROFILE value (quiet | log | json:<trace_file>).
+    An unrecognized value is reported and the 'log' sink is kept; this runs
+    at import, so it does not exit.
+    """
+    sink,_,trace_file = value.partition(':')
+    if sink not in ['quiet','log','json'] or (sink == 'json' and not trace_file):
+        print('set_profile_sink_env_1: WARNING!!, PYTB_PROFILE={0:s} not recognized, '
+              'using log'.format(value))
+        sink,trace_file = 'log',''
+    set_profile_sink_1(sink,trace_file)
+
+if os.environ.get('PYTB_PROFILE'):
+    set_profile_sink_env_1(os.environ['PYTB_PROFILE'])